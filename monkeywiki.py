@@ -20,14 +20,9 @@
     along with this program; if not, write to the Free Software
     Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA'''
 
-import cgi, re, os, sys, time
+import re, os, sys, time, marshal, itertools
 from os import path
 
-try:
-    import mwmacros
-except:
-    pass
-
 #==CONFIGURATION SECTION===========================================================================
 PATH_TO_WIKI_TEXT = '/path/to/wiki/text/files/'
 PATH_TO_TEMPLATES = '/path/to/wiki/template/files/'
@@ -41,6 +36,17 @@ BACKUP_ON = 0 #use the backup feature? (backups are done by email)
 SMTP_SERVER = 'localhost'
 WIKI_LOGGER = 'wikilogger@your.domain' #email address from which backups are sent
 WIKI_MASTER = 'wikimaster@your.domain' #email address to which backups are sent
+RENDER_CACHE_SIZE = 200 #number of rendered pages a WSGI process keeps in memory
+PATH_TO_WIKI_DATA = '' #directory for indexes and other working files ('' = don't keep any)
+INSTRUMENT = 0 #time requests? (timings are also collected in PATH_TO_WIKI_DATA if set)
+SEARCH_INDEX = 0 #answer searches for words from a word index? (needs PATH_TO_WIKI_DATA)
+SEARCH_PROCESSES = 4 #processes reading pages at once for searches the index cannot answer
+SEARCH_MAX_RESULTS = 100 #pages such a search lists at most, those with most matches (0 = no limit)
+SEARCH_TIME_LIMIT = 0 #seconds such a search may take before showing what it has found (0 = none)
+STORAGE = 'files' #keep page text in 'files' (in PATH_TO_WIKI_TEXT) or 'sqlite' (in PATH_TO_WIKI_DB)
+PATH_TO_WIKI_DB = '/path/to/wiki/pages.db' #SQLite database file, if STORAGE = 'sqlite'
+MACRO_TIMEOUT = 10 #seconds a macro may take, after which it is left out of the page
+GZIP_LEVEL = 6 #compression of pages for browsers which accept it, 1 (fastest) to 9, 0 for none
 CREDIT = 'Site powered by <a href="http://www.waywood.co.uk/MonkeyWiki/">MonkeyWiki</a>'
 #==================================================================================================
 
@@ -62,9 +68,13 @@ class WikiParser:
     class whose instances behave like a function to turn text with wiki 'mark-up' into HTML,
     or rather, XHTML now
     '''
-    #the main regular expression to recognise wiki 'mark-up'
+    #the main regular expression to recognise wiki 'mark-up'. Most of the text is the letters of
+    #words, at which no token can start except at the start of a word, a url or www. address or
+    #mailto:, or an e-mail address's last letter before a digit or underscore (after one ended
+    #there), so a lookahead for these first saves trying each kind of token at every letter
     main_re = re.compile(
-        r'(?P<empty_line>^\r\s*$)'                      #}
+        r'(?=\W|\b|(?<=[a-zA-Z])[0-9_]|https?:|ftp:|nntp:|news:|www\.|mailto:)(?:'
+        + r'(?P<empty_line>^\r\s*$)'                    #}
         + r'|(?P<list>^\r\s+[*#]?)'                     #}all these plus para_start
         + r'|(?P<heading>^\r(?P<u>_{2,6}).+(?P=u)\s*$)' #}we know will not be picked
         + r'|(?P<rule>^\r-{4,}\s*$)'                    #}up if we are in a pre block
@@ -78,13 +88,23 @@ class WikiParser:
         + r'|(?P<image>(\b|[|])((http\://)|(www\.))[-\w./~%]+((\.jpe?g)|(\.JPE?G)|(\.gif)|(\.GIF)|(\.png)|(\.PNG))([|]|\b))'
         + r'|(?P<url>(https?|ftp|nntp|news)\://[-\w./~?=&+%#]+[\w/])'
         + r'|(?P<www>www\.[-\w./~?=&+%#]+[\w/])'
-        + r'|(?P<email>(mailto:)?[-\w.+]+@[a-zA-Z0-9\-.]+[a-zA-Z])'
+        + r'|(?P<email>(mailto:)?[-\w.+]+@[a-zA-Z0-9\-.]+[a-zA-Z]))'
         )    
+    #lines after which no tags are open (an empty line, heading, rule or clear) unless in a <pre>
+    boundary_re = re.compile(r'^(?:\s*|(_{2,6}).+\1\s*|-{4,}\s*|\\{2}\s*)$')
+    #where links' numbers and macros' output go in the HTML of a block
+    marker_re = re.compile('\0([LM])([0-9]+)\0')
+    #names of the helpers which replace each type of token, by number of the named RE group
+    repl_names = dict((i, '_%s_repl' % name) for name, i in main_re.groupindex.items() if name != 'u')
     
     def __init__(self):        
         self.tagqueue, self.recyclequeue = [], []
+        self.depth = {} #number of each tag in tagqueue
         self.clear_margins = False
         self.linkref = 1
+        self.linkmark = '%s' #how a link's number is put
+        self.macrocalls = []
+        self.repl = dict([(i, getattr(self, name)) for i, name in self.repl_names.items()])
                         
     def _empty_line_repl(self, s):          
         return self.closetags(recycle=['em','strong'], ruthless=True) 
@@ -94,8 +114,8 @@ class WikiParser:
         listtype, itemtag, level = {'*': ('ul', 'li', len(s) - 1),
                                      '#': ('ol', 'li', len(s) - 1)}.get(
                                          s[-1],('blockquote', 'p', len(s)))
-        d_level = level - (self.tagqueue.count('ul') + self.tagqueue.count('ol')
-                             + self.tagqueue.count('blockquote'))
+        d_level = level - (self.depth.get('ul', 0) + self.depth.get('ol', 0)
+                           + self.depth.get('blockquote', 0))
         #get rid of open <p> if present (either within a blockquote or directly in body)
         r = self.closetags(['p'], ['em','strong'])
         #prepare for adding list item, by changing to new level or simply closing last item
@@ -135,7 +155,7 @@ class WikiParser:
         return self.closetags(recycle=['em','strong'], ruthless=True)
 
     def _para_start_repl(self, s):
-        if 'p' in self.tagqueue and 'blockquote' not in self.tagqueue:
+        if self.depth.get('p') and not self.depth.get('blockquote'):
             r = '<br />\n'
         else:
             r = self.closetags(recycle=['em','strong'], ruthless=True)\
@@ -151,11 +171,11 @@ class WikiParser:
         return r
 
     def _pre_repl(self, s):
-        if s == '{{' and 'pre' not in self.tagqueue:
-                self.pre_in_p = 'p' in self.tagqueue
+        if s == '{{' and not self.depth.get('pre'):
+                self.pre_in_p = bool(self.depth.get('p'))
                 r = self.closetags(['p'], ['em','strong'])
                 r += self.opentags(['pre'], True)
-        elif s == '}}' and 'pre' in self.tagqueue:
+        elif s == '}}' and self.depth.get('pre'):
                 r = self.closetags(['pre'], recycle=['em','strong'])
                 if self.pre_in_p:
                     self.recyclequeue.insert(0, 'p')
@@ -165,11 +185,9 @@ class WikiParser:
         return r
     
     def _macro_repl(self, s):
-        try:
-            r = eval('mwmacros.%s' % s[2:-2])
-        except:
-            r = self._comment_repl(s)
-        return r
+        #a placeholder, replaced once all the macros in the chunk of text have been run together
+        self.macrocalls.append(s)
+        return '\0M%s\0' % (len(self.macrocalls) - 1)
    
     def _comment_repl(self, s):
         if s.count('--'):   #likely to be invalid comment
@@ -181,7 +199,7 @@ class WikiParser:
     def _emph_repl(self, s):
         this_tag, other_tag = (('em', 'strong'), ('strong', 'em'))[len(s)-2]
         r = ''
-        if this_tag in self.tagqueue:
+        if self.depth.get(this_tag):
             r += self.closetags([this_tag], [other_tag], False, 1)
             r += self.opentags([], True) #reopen other tag if nece
         else:
@@ -189,18 +207,18 @@ class WikiParser:
         return r
 
     def _wiki_repl(self, s):
-        w = WikiPage(s)
-        if w.existcode:
-            r = '<a class="wikilink" href="%s">%s</a>' % (cgi.escape(w.get_href()), w.title)
+        href = escape(pageregistry.get_href(s))
+        if pageregistry.existcode(s):
+            r = '<a class="wikilink" href="%s">%s</a>' % (href, WikiName(s).spacify())
         else:
-            r = '%s<a class="nonexistent" href="%s">?</a>' % (s, cgi.escape(w.get_href()))
+            r = '%s<a class="nonexistent" href="%s">?</a>' % (s, href)
         return r
     
     def _image_repl(self, s):
         src = s.strip('|')
         if src[:7] != 'http://':
             src = 'http://' + src
-        if 'pre' in self.tagqueue:
+        if self.depth.get('pre'):
             r = self._url_repl(src)
         else:
             i = 'img src="%s" alt="%s"' % (src, src)
@@ -219,11 +237,11 @@ class WikiParser:
     def _url_repl(self, s):
         rel = ('', ' rel="nofollow"')[NOFOLLOW_OUTLINKS]
         if NUMBERED_OUTLINKS:
-            displaytext = '[%s]' % self.linkref
+            displaytext = '[%s]' % (self.linkmark % self.linkref)
             self.linkref += 1
         else:
             displaytext = s
-        return '<a href="%s"%s>%s</a>' % (cgi.escape(s), rel, displaytext)
+        return '<a href="%s"%s>%s</a>' % (escape(s), rel, displaytext)
 
     def _www_repl(self, s):
         return self._url_repl('http://' + s)
@@ -249,31 +267,33 @@ class WikiParser:
         will be closed. If 'tags', is omitted, all tags closed will be governed by this number.
         Otherwise, the action on tags appearing only in recycle is *not* governed by this number.
         '''
-        r, no_closed = '', 0
-        while self.tagqueue and (no_closed<count or count==None):
-            if [i for i in (tags + recycle) if i in self.tagqueue] or tags==[]:
-                last_tag = self.tagqueue[-1]
-                if last_tag in (tags + recycle) or ruthless == True:                
+        r, no_closed = [], 0
+        closeable = tags + recycle
+        tagqueue, depth = self.tagqueue, self.depth
+        while tagqueue and (no_closed<count or count==None):
+            if [i for i in closeable if depth.get(i)] or tags==[]:
+                last_tag = tagqueue[-1]
+                if last_tag in closeable or ruthless == True:                
                     if last_tag in recycle:
                         self.recyclequeue.insert(0, last_tag)
-                    r += '</%s>' % (self.tagqueue.pop())
+                    r.append('</%s>' % tagqueue.pop())
+                    depth[last_tag] -= 1
                     if last_tag in tags or tags==[]:
                         no_closed += 1
                 else:
                     break
             else:
                 break
-        return r
+        return ''.join(r)
 
     def opentags(self, tags, openrecycled=False):
-        r = ''
         if openrecycled:
-            tags += self.recyclequeue
+            tags = tags + self.recyclequeue
             self.recyclequeue = []
         for i in tags:
-            r += '<%s>' % i
             self.tagqueue.append(i)        
-        return r
+            self.depth[i] = self.depth.get(i, 0) + 1
+        return ''.join(['<%s>' % i for i in tags])
         
     def do_clear(self, s):
         '''places a style attribute in the first available html tag which, by the context in which
@@ -286,38 +306,149 @@ class WikiParser:
         return r        
 
     def replace(self, match):
-        'calls appropriate helper (based on named RE group) to replace each type of token'
-        tokentype = match.lastgroup
-        token = match.groupdict()[tokentype]
-        return getattr(self, '_' + tokentype + '_repl')(token)
+        'calls appropriate helper (based on number of RE group matched) to replace each type of token'
+        i = match.lastindex
+        return self.repl[i](match.group(i))
 
     def __call__(self, text):
         'main HTML formatter function'
-        html = ''
-        
+        return ''.join(self.stream(text))
+
+    def stream(self, text, chunklines=0):
+        '''generate the HTML in chunks, each from that many lines of the text (or all in one chunk
+        if 0), so that the start can be sent on before the rest is made'''
         if text.strip():
-            #turn all traces of HTML tags into readable, non-functional versions
-            text = cgi.escape(text, 1)
+            #turn all traces of HTML tags into readable, non-functional versions, and remove NULs,
+            #which mark macro calls (and links, in stream_blocks) while the text is rendered
+            text = escape(text, 1).replace('\0', '')
             #start
+            lines, sub, depth, held = [], self.main_re.sub, self.depth, ''
             for line in text.splitlines():
                 #put in \r or \n line beginnings as part of the recognition for block-level element 
                 #tags, depending on whether we are inside a <pre> block at this point. If we're not,
                 #the \r will be found and transformed into \n + appropriate block level element tag
                 #(or blank line). Otherwise, \n will be left to be expressed inside <pre> block.
-                line = ('\r', '\n')['pre' in self.tagqueue] + line
+                line = ('\r', '\n')[depth.get('pre', 0) > 0] + line
                 #main substitution call
-                html += re.sub(self.main_re, self.replace, line)
-                
-            #remove redundant markup left over from correct nesting enforcement for emphasis tags
-            html = html.replace('<em></em>', '')
+                lines.append(sub(self.replace, line))
+                if len(lines) == chunklines:
+                    html, held = self.finish(held + self.run_macros(lines))
+                    lines = []
+                    if html: yield html
+
+            html = self.finish(held + self.run_macros(lines), True)[0]
             #close any tags left open & reset state variables for next use
-            html += self.closetags(ruthless=True)   
+            yield html + self.closetags(ruthless=True)
             self.__init__()                         
 
+    def stream_blocks(self, text, cache, chunklines=0):
+        '''generate the same as stream, but reusing from cache (a BlockCache) the HTML of blocks of
+        the text rendered before. A block ends with a line after which no tags are open, so that
+        it renders the same wherever it is, given only which tags are waiting to be reopened and
+        whether margins are to be cleared. Links are numbered and macros run once the blocks are
+        put together'''
+        if text.strip():
+            text = escape(text, 1).replace('\0', '') #as in stream
+            lines, held, linkref, n = [], '', 1, 0
+            for block in self.blocks(text.splitlines()):
+                key = (self.blockhash(block), tuple(self.recyclequeue), self.clear_margins)
+                entry = cache.get(key)
+                if entry is None:
+                    entry = cache[key] = self.render_block(block)
+                html, links, calls, recyclequeue, self.clear_margins, tail, names = entry
+                self.recyclequeue = list(recyclequeue)
+                if links or calls:
+                    offset = {'L': linkref - 1, 'M': len(self.macrocalls)}
+                    def renumber(match):
+                        r = int(match.group(2)) + offset[match.group(1)]
+                        return ('%s', '\0M%s\0')[match.group(1) == 'M'] % r
+                    html = self.marker_re.sub(renumber, html)
+                lines.append(html)
+                self.macrocalls.extend(calls)
+                linkref += links
+                n += len(block)
+                if chunklines and n >= chunklines:
+                    html, held = self.finish(held + self.run_macros(lines))
+                    lines, n = [], 0
+                    if html: yield html
+            cache.save()
+            yield self.finish(held + self.run_macros(lines), True)[0] + tail
+            self.__init__()
+
+    def blocks(self, lines):
+        'split lines of (escaped) text into lists of lines, each ending at a block boundary'
+        block, inpre = [], False
+        for line in lines:
+            block.append(line)
+            if not inpre and self.boundary_re.match(line):
+                yield block
+                block = []
+            elif '{{' in line or '}}' in line:
+                #find whether a <pre> block has started or ended, as the parser will
+                for match in self.main_re.finditer(('\r', '\n')[inpre] + line):
+                    if match.group('pre') == ('{{', '}}')[inpre]:
+                        inpre = not inpre
+        if block:
+            yield block
+
+    def blockhash(self, block):
+        import hashlib
+        return hashlib.md5('\n'.join(block)).digest()
+
+    def render_block(self, block):
+        '''a BlockCache entry for a block: its HTML, the numbers of links and of macro calls in
+        it, the tags waiting to be reopened and whether margins are to be cleared after it, the
+        tags to close if it is the last, and the existence of each page it may link to'''
+        outer = self.macrocalls
+        self.tagqueue, self.depth, self.linkref, self.macrocalls = [], {}, 1, []
+        self.linkmark = '\0L%s\0'
+        lines = []
+        for line in block:
+            line = ('\r', '\n')[self.depth.get('pre', 0) > 0] + line
+            lines.append(self.main_re.sub(self.replace, line))
+        tail = ''.join(['</%s>' % i for i in reversed(self.tagqueue)])
+        names = tuple([(i, pageregistry.existcode(i))
+                       for i in set(LinkIndex.link_re.findall('\n'.join(block)))])
+        entry = (''.join(lines), self.linkref - 1, self.macrocalls, tuple(self.recyclequeue),
+                 self.clear_margins, tail, names)
+        self.macrocalls = outer
+        return entry
+
+    def run_macros(self, lines):
+        'join lines of output, with the output of the macros called in them in place'
+        html = ''.join(lines)
+        if self.macrocalls:
+            with instrument.phase('macros'):
+                html = macros.splice(html, self.macrocalls, self._comment_repl)
+            self.macrocalls = []
         return html
 
+    def finish(self, html, last=False):
+        '''remove redundant markup left over from correct nesting enforcement for emphasis tags.
+        Unless this is the last of the output, return separately the end of it which may be the
+        start of such markup, to be finished with what follows'''
+        cut = len(html)
+        if not last:
+            cut = max(0, cut - len('<em></em>') + 1)
+            i = html.find('<em></em>', max(0, cut - len('<em></em>') + 1))
+            if i != -1 and i < cut:
+                cut = i + len('<em></em>')
+        return html[:cut].replace('<em></em>', ''), html[cut:]
+
 
 class WikiPage:
+    longstop_template = '''<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN"
+        "http://www.w3.org/TR/2002/REC-xhtml1-20020801/DTD/xhtml1-strict.dtd">
+        <html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
+        <head><title><!--#self.title--></title>
+        <style type="text/css">
+        #header {border-bottom-width: 2px; border-bottom-style: groove;}
+        #footer {border-top-width: 2px; border-top-style: groove; clear:both;}
+        </style></head>
+        <body><!--#wiki--></body></html>'''
+    stream_lines = 100 #lines of text rendered in each chunk of streamed output
+    render_wait = 5 #seconds to wait for another process rendering a page (see claim_render)
+
     def __init__(self, page, action='', **otherparams):
         self.__dict__ = otherparams
         wn = WikiName(page)
@@ -329,7 +460,7 @@ class WikiPage:
             self.existcode = 2  #special auto-generated page
             self.action = action.lower() or 'goto'
             self.ok_actions = ['goto', 'likesearch', 'backsearch']
-        elif os.path.isfile(self.textfile):
+        elif storage.exists(page):
             self.existcode = 1  #physically existing page
             self.action = action.lower() or 'goto'
             self.ok_actions = ['goto', 'edit', 'rename', 'delete', 'likesearch', 'backsearch','localmap']
@@ -339,47 +470,86 @@ class WikiPage:
             self.ok_actions = ['edit', 'likesearch','backsearch','localmap']
         if not EDITABLE:
             self.ok_actions = [i for i in self.ok_actions if i not in ['edit', 'rename', 'delete']]
+        #the history of a deleted page only where it may be restored, so that deleting a page
+        #otherwise takes it out of sight (see also the 'purgehistory' command)
+        if PATH_TO_WIKI_DATA and (self.existcode == 1
+                                  or self.existcode == 0 and EDITABLE and pagehistory.exists(page)):
+            self.ok_actions += ['history', 'diff']
         self.HTMLfile = path.join(os.getenv('DOCUMENT_ROOT'),
                                   REWRITE_BASE_URL.lstrip('/'), page + '.html')
         self.cache_me = 0 #only for internal use
+        self.render_lock = None #see claim_render
+        self.rendering_elsewhere = False
+        self.stale = False #whether claim_render gave the stale copy
         
     def __str__(self):
         if self.existcode == 2:
             r = str(AutoPage(self))
+        elif self.existcode == 1:
+            with instrument.phase('htmlize'):
+                r = ''.join(self.render())
         else:
             r = htmlize(self.get_text())
         return r
 
+    def render(self, chunklines=0):
+        '''generate the HTML of the page's text in chunks (see WikiParser.stream), re-rendering
+        only the blocks of it which have changed since it was last rendered, if PATH_TO_WIKI_DATA
+        is set to keep them in'''
+        if PATH_TO_WIKI_DATA:
+            return WikiParser().stream_blocks(self.get_text(), BlockCache(self.page), chunklines)
+        return WikiParser().stream(self.get_text(), chunklines)
+
     def goto(self, message=''):
         if message:
             msgstr = '<p class="message">%s</p>' % message
         else:
             msgstr = ''
-            if REWRITE_MODE == 2 and self.existcode == 1: self.cache_me = 1
+            if REWRITE_MODE == 2 and self.existcode == 1 and not self.rendering_elsewhere:
+                self.cache_me = 1
         return msgstr + str(self)
 
+    def stream_goto(self):
+        'generate what goto gives, in chunks as it is rendered'
+        if REWRITE_MODE == 2 and self.existcode == 1 and not self.rendering_elsewhere:
+            self.cache_me = 1
+        if self.existcode == 2:
+            return AutoPage(self).stream()
+        return self.render(self.stream_lines)
+
     def edit(self):
-        save = getattr(self, 'save', '')
-        if save != 'Save':
-            r = '''<form method="post" action="%s">
-            <p><input type="hidden" name="page" value="%s" />
-            <input type="hidden" name="action" value="edit" />
-            <textarea name="newtext" rows="17" cols="80">%s</textarea><br />
-            <input type="submit" value="Save" name="save" />
-            <input type="reset" value="Reset" /></p></form>
-            ''' % (os.getenv('SCRIPT_NAME'), self.page, cgi.escape(self.get_text(), 1))
+        if getattr(self, 'save', '') != 'Save':
+            #given a revision, start from its text, to restore it
+            rev, message = getattr(self, 'rev', '') and self.get_rev() or (0, '')
+            r = self.edit_form(rev and pagehistory.text(self.page, rev) or self.get_text(),
+                               message)
         else:
             assert os.getenv('REQUEST_METHOD') == 'POST', 'Only POST allowed'
             #next 2 lines create version of self.newtext ensuring LF linebreaks
             newlines = getattr(self, 'newtext', '').splitlines(False)
             newtext = '\n'.join(newlines)
-            if not newtext.strip():             #new text is nil or just space
+            with PageLock([self.page]):
+                #compare with the page as it is now, which may not be as it was given for editing
+                self.existcode = int(storage.exists(self.page))
+                #the form drops the blank token of a page given as not existing, so a save
+                #without one is from that (and one of an existing page from it conflicts)
+                conflict = getattr(self, 'token', '') != self.get_token()
+                changed = not conflict and newtext.strip() and newtext != self.get_text()
+                if changed:                     #new text exists and is different from old text
+                    self.kill_HTMLfile()
+                    self.refresh_dependents()
+                    self.backup()
+                    old = (None, self.get_text())[self.existcode]
+                    pagehistory.record(self.page, 'edit', newtext, old)
+                    storage.write(self.page, newtext)
+                    pageregistry.add(self.page)
+                    reindex_pages({self.page: newtext})
+                    changejournal.record(self.page, 'edit')
+            if conflict:                        #someone else has saved it since it was given
+                r = self.conflict(newtext)
+            elif not newtext.strip():           #new text is nil or just space
                 r = self.delete()
-            elif newtext != self.get_text():    #new text exists and is different from old text
-                self.kill_HTMLfile()
-                self.refresh_dependents()
-                self.backup()
-                file(self.textfile,'w').write(newtext)
+            elif changed:
                 self.__init__(self.page)
                 r = self.goto('Thank you for your update')
             else:                               #new text is the same as old text
@@ -387,6 +557,40 @@ class WikiPage:
                 r = self.goto()
         return r
 
+    def edit_form(self, text, message=''):
+        '''the form for editing the page, starting from text. It carries the token of the page's
+        text as it is now, so that saving it cannot overwrite changes saved in the meantime'''
+        return '''%s<form method="post" action="%s">
+            <p><input type="hidden" name="page" value="%s" />
+            <input type="hidden" name="action" value="edit" />
+            <input type="hidden" name="token" value="%s" />
+            <textarea name="newtext" rows="17" cols="80">%s</textarea><br />
+            <input type="submit" value="Save" name="save" />
+            <input type="reset" value="Reset" /></p></form>
+            ''' % (message, os.getenv('SCRIPT_NAME'), self.page, self.get_token(),
+                   escape(text, 1))
+
+    def conflict(self, newtext):
+        '''the edit form again, for text which was being edited while someone else saved the page:
+        with the changes in it merged with theirs, if the text it was edited from is in the page's
+        history, otherwise as it is, and with its differences from the page as now saved'''
+        saved = (None, self.get_text())[self.existcode]
+        base = pagehistory.find(self.page, getattr(self, 'token', ''))
+        message = 'Someone else has saved this page since you began to edit it.'
+        if base is not None:
+            lines, conflicts = merge(base.split('\n'), newtext.split('\n'),
+                                     (saved or '').split('\n'))
+            newtext = '\n'.join(lines)
+            message += (' Your changes have been merged with theirs below: check them and save.',
+                        ' Your changes have been merged with theirs below, but %s of them '
+                        'conflict, and are marked with <<<<<<< and >>>>>>>: choose between them'
+                        ' and save.' % conflicts)[bool(conflicts)]
+        else:
+            message += ' Your text is below: compare it with theirs and save.'
+        return self.edit_form(newtext, '<p class="message">%s</p>\n' % escape(message)) \
+               + '<p>How the page as now saved differs from the text above:</p>\n' \
+               + htmldiff(newtext.split('\n'), (saved or '').split('\n'))
+
     def delete(self):     
         confirmdelete = getattr(self, 'confirmdelete', '')
         if not confirmdelete:
@@ -400,10 +604,17 @@ class WikiPage:
             '''% (os.getenv('SCRIPT_NAME'), self.title, self.page)
         elif confirmdelete == 'Yes':
             assert os.getenv('REQUEST_METHOD') == 'POST', 'only POST allowed'
-            self.kill_HTMLfile()
-            self.refresh_dependents()
-            self.backup()
-            os.remove(self.textfile)
+            with PageLock([self.page]):
+                assert storage.exists(self.page), 'The page has already been deleted'
+                self.kill_HTMLfile(False)
+                self.refresh_dependents()
+                self.backup()
+                pagehistory.record(self.page, 'delete', None, self.get_text())
+                storage.remove(self.page)
+                BlockCache(self.page).discard()
+                pageregistry.discard(self.page)
+                reindex_pages({self.page: None})
+                changejournal.record(self.page, 'delete')
             msg = "The page '%s' has been deleted" % self.title
             self.__init__(FRONT_PAGE)
             r = self.goto(msg)
@@ -425,23 +636,10 @@ class WikiPage:
             '''% (os.getenv('SCRIPT_NAME'), self.page, self.page)
         else:
             assert os.getenv('REQUEST_METHOD') == 'POST', 'only POST allowed'
-            ren_wp = WikiPage(newname)
-            if ren_wp.existcode:
-                raise Exception, 'Cannot overwrite %s page'\
-                      % ('existing', 'automatic')[ren_wp.existcode - 1]
-            else:
-                self.kill_HTMLfile()
-                self.refresh_dependents()
-                self.backup()
-                os.rename(self.textfile, ren_wp.textfile)
-                #amend refering pages to show the new name
-                for page in self.get_referers():
-                    w = WikiPage(page)
-                    changedtext = re.sub(r'\b%s\b' % self.page, newname, w.get_text())
-                    file(w.textfile,'w').write(changedtext)
-                msg = "The page '%s' has been renamed to '%s'" % (self.title, ren_wp.title)
-                self.__init__(newname)
-                r = self.goto(msg)
+            batchrename.rename({self.page: newname})
+            title = self.title
+            self.__init__(newname)
+            r = self.goto("The page '%s' has been renamed to '%s'" % (title, self.title))
         return r
         
     def likesearch(self):
@@ -455,65 +653,188 @@ class WikiPage:
         return htmlize("__Pages referring to '%s'__\n *%s" %\
                        (self.title, '\n *'.join(self.get_referers()) or '[None]'))
 
+    def get_rev(self, latest=False):
+        '''the revision given by rev, kept to those the page has (the latest, if latest is set and
+        rev is not given), and a message saying so if it was not one of them: 0 and a message if
+        the page has none'''
+        count, rev = pagehistory.count(self.page), getattr(self, 'rev', '')
+        if not count:
+            return 0, '<p class="message">The page has no history</p>\n'
+        if latest and not rev:
+            return count, ''
+        try: n = int(rev)
+        except ValueError: n = 0
+        if 0 < n <= count:
+            return n, ''
+        n = min(max(n, 1), count)
+        return n, '<p class="message">There is no revision %s, only 1 to %s: showing %s</p>\n'\
+               % (escape(str(rev)), count, n)
+
+    def history(self):
+        'the revisions of the page, latest first, or the text of one if rev is given'
+        if getattr(self, 'rev', ''):
+            rev, message = self.get_rev()
+            if not rev: return message
+            text = pagehistory.text(self.page, rev)
+            return '%s<p class="message">Revision %s of %s, %s</p>\n%s' % (
+                message, rev, pagehistory.count(self.page),
+                time.ctime(pagehistory.revisions(self.page, rev, rev)[0][0]),
+                text is None and '<p>The page had gone</p>' or htmlize(text))
+        revisions, lines = pagehistory.revisions(self.page), []
+        for n in range(len(revisions), 0, -1):
+            when, action, client, note, kind = revisions[n - 1]
+            links = [('diff', 'Changes')]
+            if kind != 'x':
+                links.insert(0, ('history', 'View'))
+                if EDITABLE and n < len(revisions):
+                    links.append(('edit', 'Restore'))
+            details = ''.join([' ' + i for i in [note, client and 'by ' + client] if i])
+            lines.append('<li>%s. %s: %s%s (%s)</li>' % (
+                n, time.ctime(when), action, escape(details),
+                ' | '.join(['<a href="%s">%s</a>'
+                            % (escape(get_href(self.page, i) + '&rev=%s' % n), label)
+                            for i, label in links])))
+        return '<ul class="history">\n%s</ul>' % ('\n'.join(lines) or '<li>[None]</li>')
+
+    def diff(self):
+        'the changes made in a revision (the latest, unless rev is given) to the one before'
+        rev, message = self.get_rev(True)
+        if not rev: return message
+        old, new = [(pagehistory.text(self.page, i) or '').split('\n') for i in (rev - 1, rev)]
+        return '%s<p class="message">Changes made in revision %s, %s</p>\n%s'\
+               % (message, rev, time.ctime(pagehistory.revisions(self.page, rev, rev)[0][0]),
+                  htmldiff(old, new))
+
     def backup(self):
         if not BACKUP_ON: return
 
-        import smtplib, email.MIMEMultipart, email.MIMEText
         notification = "At %s, %s %sed '%s'" % (
-            time.ctime(), os.getenv('HTTP_X_FORWARDED_FOR', os.getenv('REMOTE_ADDR', '[unknown]')),
-            self.action.rstrip('e'), self.page)
+            time.ctime(), client_address(), self.action.rstrip('e'), self.page)
+        record = {'page': self.page, 'action': self.action, 'notification': notification}
 
         if self.action == 'rename':
-            notification += " to '%s'" % self.newname
-            m = email.MIMEText.MIMEText(notification)
+            record['notification'] += " to '%s'" % self.newname
         else:
-            att = email.MIMEText.MIMEText(self.get_text())
-            att.add_header('Content-Disposition', 'attachment', filename=self.page)
-            m = email.MIMEMultipart.MIMEMultipart()
-            m.attach(email.MIMEText.MIMEText(notification))
-            m.attach(att)
-            m.epilogue = ''
+            record['text'] = self.get_text()
 
-        m['From'],m['To'],m['Subject'] = WIKI_LOGGER,WIKI_MASTER,'%s %s'%(self.page, self.action)
-
-        server = smtplib.SMTP(SMTP_SERVER)
-        server.sendmail(WIKI_LOGGER, [WIKI_MASTER], m.as_string())
-        server.quit()
+        with instrument.phase('backup'):
+            if PATH_TO_WIKI_DATA:
+                backupspool.add(record) #to be sent by the 'sendbackups' command
+            else:
+                sender = BackupSender(1) #no pauses to retry while the visitor waits
+                sender.send([record])
+                sender.close()
 
     def get_text(self):
-        return eval(('"Type your text here"', "file(self.textfile).read()", '""')[self.existcode])
+        r = eval(('"Type your text here"', "storage.read(self.page)", '""')[self.existcode])
+        if self.existcode == 1:
+            instrument.count('get_text')
+            instrument.count('bytes read', len(r))
+        return r
               
+    def get_token(self):
+        'the token of the text of the page as it is now (see text_token)'
+        return text_token((None, self.get_text())[self.existcode == 1])
+
     def get_href(self):
-        if REWRITE_MODE and self.action == 'goto':
-            r = path.join(REWRITE_BASE_URL, self.page + '.html')
-        else:
-            r = '%s?page=%s' % (os.getenv('SCRIPT_NAME'), self.page)
-            if self.action != 'goto':
-                r += '&action=' + self.action
-        return r
+        return get_href(self.page, self.action)
     
     def get_referers(self):
-        p = re.compile(r'\b%s\b' % self.page)
-        r = [i for i in getwikipagelist() if p.search(WikiPage(i).get_text())]
+        if linkindex.enabled():
+            r = linkindex.referers(self.page)
+        else:
+            p = re.compile(r'\b%s\b' % self.page)
+            r = [page for page, text in storage.readall() if p.search(text)]
         r.sort()
         return r
 
     def get_includers(self):
-        p = re.compile(r'\b%s\b' % self.page)
-        includer_templates = [i for i in os.listdir(PATH_TO_TEMPLATES)
-                              if p.search(file(path.join(PATH_TO_TEMPLATES, i)).read())]
+        'pages whose output may include this one, through their templates'
         r = []
-        for i in includer_templates:
+        for i in templateindex.includers(self.page):
             if i == 'default':
-                r = getwikipagelist()
-                break
+                #only pages without templates of their own use the default
+                own = set(templateindex.templates())
+                r += [page for page in getwikipagelist() if page not in own]
             elif WikiName(i).is_valid():
                 r.append(i)
         return r
 
-    def kill_HTMLfile(self):
-        if REWRITE_MODE == 2 and path.isfile(self.HTMLfile):
-            os.remove(self.HTMLfile) #if fails, allow exception
+    def get_version(self):
+        '''value which changes whenever the output of 'goto' may have: when the page, its template,
+        the pages that includes or the set of existing pages (on which the rendering of its links
+        depends) has changed. None if the output may change at any time, as that of the macros
+        called in the page or those it includes may'''
+        r = [storage.mtime(self.page), storage.version()]
+        for i in [PATH_TO_TEMPLATES, path.join(PATH_TO_TEMPLATES, self.page),
+                  path.join(PATH_TO_TEMPLATES, 'default')]:
+            try: r.append(path.getmtime(i))
+            except OSError: r.append(None)
+        #the template used, as do_frame finds it
+        template = (r[-2] is not None and self.page) or (r[-1] is not None and 'default')
+        pages = [self.page] + (template and templateindex.names(template) or [])
+        for page in pages:
+            try:
+                if '[[' in storage.read(page): #a macro call, or something like one
+                    return None
+                if page != self.page: r.append(storage.mtime(page))
+            except (IOError, OSError):
+                r.append(None)
+        return tuple(r)
+
+    def kill_HTMLfile(self, keep_stale=True):
+        '''remove the page's HTML file for REWRITE_MODE 2, keeping it marked stale (unless the page
+        has gone) to be served while the page is being rendered again (see claim_render)'''
+        if REWRITE_MODE == 2:
+            for i in ['.gz', '.br']: #compressed copies first, so that none outlives the original
+                if path.isfile(self.HTMLfile + i):
+                    os.remove(self.HTMLfile + i)
+            if path.isfile(self.HTMLfile):
+                os.rename(self.HTMLfile, self.HTMLfile + '.stale') #if fails, allow exception
+            if not keep_stale and path.isfile(self.HTMLfile + '.stale'):
+                os.remove(self.HTMLfile + '.stale')
+
+    def claim_render(self):
+        '''for REWRITE_MODE 2, where many requests may come at once for a page whose HTML file has
+        just been removed: return the page's HTML if it can be had without rendering it, or None
+        if this process is to render it. Only one process renders a page at a time, holding a lock
+        on the file page.render among the locks of PageLock (not beside its HTML file, where it
+        would be served). Any others serve the stale copy of the HTML file if there is one, or wait
+        up to render_wait seconds for the new one, before rendering it themselves (without saving
+        it)'''
+        import fcntl
+        r = self.read_HTMLfile('')
+        if r is None:
+            dirname = path.join(PATH_TO_WIKI_DATA or PATH_TO_WIKI_TEXT, 'locks')
+            try: os.mkdir(dirname)
+            except OSError: pass #already made
+            self.render_lock = file(path.join(dirname, self.page + '.render'), 'w')
+            try:
+                fcntl.flock(self.render_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                self.release_render()
+                r = self.read_HTMLfile('.stale')
+                self.stale = r is not None
+                deadline = time.time() + self.render_wait
+                while r is None and time.time() < deadline:
+                    time.sleep(0.05)
+                    r = self.read_HTMLfile('')
+                self.rendering_elsewhere = r is None
+            else:
+                #another process may have finished rendering it just before
+                r = self.read_HTMLfile('')
+                if r is not None:
+                    self.release_render()
+        return r
+
+    def read_HTMLfile(self, suffix):
+        try: return file(self.HTMLfile + suffix).read()
+        except IOError: return None
+
+    def release_render(self):
+        if self.render_lock:
+            self.render_lock.close()
+            self.render_lock = None
 
     def refresh_dependents(self):
         if REWRITE_MODE == 2:
@@ -523,22 +844,19 @@ class WikiPage:
     def do_action(self):
         assert self.action in self.ok_actions, 'You may not %s this page' % self.action        
         #contents - do this first, as it affects the nature of the other components
-        self.contents = '<div id="contents">%s</div>' % getattr(self, self.action)()
-        #template - set up longstop template, then overwrite it if a user-defined one is found
-        self.template = '''<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN"
-        "http://www.w3.org/TR/2002/REC-xhtml1-20020801/DTD/xhtml1-strict.dtd">
-        <html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
-        <head><title><!--#self.title--></title>
-        <style type="text/css">
-        #header {border-bottom-width: 2px; border-bottom-style: groove;}
-        #footer {border-top-width: 2px; border-top-style: groove; clear:both;}
-        </style></head>
-        <body><!--#wiki--></body></html>'''
+        with instrument.phase('action'):
+            self.contents = '<div id="contents">%s</div>' % getattr(self, self.action)()
+        self.do_frame()
+
+    def do_frame(self):
+        'the template, header and footer, for the action as it now is'
+        #template - use a user-defined one if found, otherwise the longstop template
         for i in [(self.action, self.page)[self.action == 'goto'], 'default']:
-            try:
-                self.template = file(path.join(PATH_TO_TEMPLATES, i)).read()
+            self.template = templatecache.get(i)
+            if self.template:
                 break
-            except: pass              
+        else:
+            self.template = templatecache.longstop
         #header
         if self.action == 'goto':
             self.header = '<div id="header"><h1>%s</h1></div>' % self.title
@@ -546,28 +864,58 @@ class WikiPage:
             self.header = '<div id="header"><h1>\'%s\': %s</h1></div>' % (self.title, self.action.capitalize())
         #footer
         pagelinks = ' | '.join(
-            ['<a href="%s">%s</a>' % (cgi.escape(WikiPage(self.page, i).get_href()), i.capitalize())
+            ['<a href="%s">%s</a>' % (escape(get_href(self.page, i)), i.capitalize())
              for i in self.ok_actions if i != self.action])
-        sitelinkpages = [WikiPage(i) for i in
-                         [FRONT_PAGE] + dir(AutoPage) if WikiName(i).is_valid() and i != self.page]
         sitelinks = ' | '.join(
-            ['<a href="%s">%s</a>' % (cgi.escape(i.get_href()), i.title) for i in sitelinkpages])
+            [pageregistry.sitelink(i) for i in [FRONT_PAGE] + pageregistry.autopages
+             if i != self.page and (INSTRUMENT or i != 'RequestTimes') and i != 'RenamePages'])
         self.footer = '<div id="footer">%s<br />%s<p id="credit">%s</p></div>'\
                       % (pagelinks, sitelinks, CREDIT)
 
     def web_output(self):
-        self.do_action()
+        with instrument.phase('do_action'):
+            self.do_action()
         wiki = '\n'.join([getattr(self, i) for i in ['header', 'contents', 'footer']])
 
-        def evaltext(m, g=globals(), l=locals()):
-            try: return str(eval(m.group(1), g, l))
-            except: return m.group(0)
-        r = re.sub(r'<!--#(.+?)-->', evaltext, self.template)
+        with instrument.phase('template'):
+            r = self.template.substitute(globals(), {'self': self, 'wiki': wiki})
 
         if self.cache_me:
-            file(self.HTMLfile, 'w').write(r)
+            self.write_HTMLfile(r)
+        self.release_render()
 
         return r
+
+    def write_HTMLfile(self, r):
+        '''write the page's HTML file for REWRITE_MODE 2, given its HTML r, whether just made or
+        kept from before (in a RenderCache) by a process which has claimed it (see claim_render)'''
+        w = CacheWriter(self.HTMLfile)
+        try:
+            w.write(r)
+            w.close()
+        finally:
+            w.abort()
+            self.release_render()
+
+    def web_stream(self):
+        '''generate the output of web_output in chunks. For 'goto', the template up to the page's
+        contents is given first, and then the contents as they are rendered. Other actions are
+        given in one chunk'''
+        if self.action != 'goto':
+            yield self.web_output()
+            return
+        assert self.action in self.ok_actions, 'You may not %s this page' % self.action
+        contents = self.stream_goto()
+        self.do_frame()
+        w = self.cache_me and CacheWriter(self.HTMLfile)
+        try:
+            for chunk in self.template.stream(globals(), {'self': self}, contents):
+                if w: w.write(chunk)
+                yield chunk
+            if w: w.close()
+        finally:
+            if w: w.abort()
+            self.release_render()
     
 class AutoPage:
     '''Provide automatically generated content for certain pages. The existence of a suitably
@@ -575,96 +923,2334 @@ class AutoPage:
     
     def __init__(self, wikipage):
         self.wikipage = wikipage        
+        self.streaming = False
+
+    def html(self, text, after=''):
+        '''text turned into HTML, followed by after: a generator of chunks of it if streaming,
+        otherwise a string'''
+        if self.streaming:
+            return itertools.chain(WikiParser().stream(text, self.wikipage.stream_lines), [after])
+        return htmlize(text) + after
 
     def SiteMap(self, top_page=None):
-        def mapchildren(page, indent):
-            pagechildren = re.findall(r'\b%s\b' % WikiName.re, WikiPage(page).get_text())
-            for child in pagechildren:
+        top_page = top_page or FRONT_PAGE
+        if linkindex.enabled():
+            def render():
+                forward = linkindex.forward()
+                return htmlize(self.mappages(top_page, forward.keys(),
+                                             lambda page: forward.get(page, [])))
+            return sitemapcache.get(top_page, render)
+        def links(page):
+            r = []
+            for i in LinkIndex.link_re.findall(WikiPage(page).get_text()):
+                if i not in r: r.append(i)
+            return r
+        return self.html(self.mappages(top_page, getwikipagelist(), links))
+
+    def mappages(self, top_page, pages, links):
+        '''wiki text of a map of the pages as a tree, following links (a function giving the
+        WikiNames in a page in order of first appearance) depth first from top_page, without
+        recursion'''
+        unmappedpages, wantedpages = set(pages), set()
+        unmappedpages.discard(top_page)
+        self.autotext = ['__Tree of pages, starting from %s__\n *%s\n' % (top_page, top_page)]
+        stack = [(iter(links(top_page)), 2)] #children of each page on the way down, & indent
+        while stack:
+            children, indent = stack[-1]
+            for child in children:
                 if child in unmappedpages:
-                    self.autotext += '%s*%s\n' %(' ' * indent, child)
+                    self.autotext.append('%s*%s\n' %(' ' * indent, child))
                     unmappedpages.remove(child)
-                    mapchildren(child, indent + 1)
-                elif WikiPage(child).existcode == 0 and child not in wantedpages:
-                    wantedpages.append(child)
-        top_page = top_page or FRONT_PAGE
-        wantedpages = []
-        unmappedpages = [i for i in getwikipagelist() if i != top_page]
-        self.autotext = '__Tree of pages, starting from %s__\n *%s\n' % (top_page, top_page)
-        mapchildren(top_page, 2)
-        unmappedpages.sort()
-        self.autotext += '__Pages outside tree__\n *'\
-                         + ('\n *'.join(unmappedpages) or '[None]') + '\n'
-        wantedpages.sort()
-        self.autotext += '__Wanted pages__\n *'\
-                         + ('\n *'.join(wantedpages) or '[None]') + '\n'
-        return htmlize(self.autotext)
+                    stack.append((iter(links(child)), indent + 1))
+                    break
+                elif pageregistry.existcode(child) == 0:
+                    wantedpages.add(child)
+            else:
+                stack.pop()
+        self.autotext.append('__Pages outside tree__\n *'
+                             + ('\n *'.join(sorted(unmappedpages)) or '[None]') + '\n')
+        self.autotext.append('__Wanted pages__\n *'
+                             + ('\n *'.join(sorted(wantedpages)) or '[None]') + '\n')
+        self.autotext = ''.join(self.autotext)
+        return self.autotext
                 
     def SiteSearch(self):
-        searchtext = getattr(self.wikipage, 'searchtext', '')
+        searchtext, after = getattr(self.wikipage, 'searchtext', ''), ''
         if searchtext:
-            titlehits, texthits = [], []
-            for page in getwikipagelist():
-                p = re.compile(searchtext, re.I + re.M)
-                w = WikiPage(page)
-                titlehits.append((w.page, p.search(w.title)))
-                texthits.append((len(p.findall(w.get_text())), w.page))
+            p = re.compile(searchtext, re.I + re.M)
+            indexed = termindex.enabled() and termindex.can_search(searchtext)
+            if indexed:
+                pages = termindex.pages()
+                counts = termindex.search(searchtext)
+                texthits = [(counts.get(i, 0), i) for i in pages]
+                texthits.sort(); texthits.reverse()
+                textlist = ' *' + ('\n *'.join(['%s (%s)' % (i[1], i[0])
+                                                for i in texthits if i[0]]) or '[None]')
+            else:
+                pages = getwikipagelist()
+                texthits, searched, stopped = regexsearch.search(searchtext, pages)
+                #snippets of page text cannot go in wiki text, so are listed after it as HTML
+                after = ''.join(['<li><a class="wikilink" href="%s">%s</a> (%s)<br />%s</li>\n'
+                                 % (escape(pageregistry.get_href(i[1])),
+                                    WikiName(i[1]).spacify(), i[0], i[2])
+                                 for i in texthits[:SEARCH_MAX_RESULTS or None]])
+                after = after and '\n<ul class="searchhits">\n%s</ul>\n' % after
+                textlist = (' *[None]', '')[bool(after)]
+                if SEARCH_MAX_RESULTS and len(texthits) > SEARCH_MAX_RESULTS:
+                    textlist += "\n''The %s pages with most matches of the %s found''"\
+                                % (SEARCH_MAX_RESULTS, len(texthits))
+                if stopped:
+                    textlist += "\n''Stopped after %s of the %s pages had been searched''"\
+                                % (searched, len(pages))
+            titlehits = [(i, p.search(WikiName(i).spacify())) for i in pages]
             titlehits.sort()
-            texthits.sort(); texthits.reverse()
             self.autotext = '''__Matches for: %s__\n___Title matches___\n *%s\n----
-            \n___Text matches (& number of matches)___\n *%s
-            ''' % (searchtext, '\n *'.join([i[0] for i in titlehits if i[1]]) or '[None]',
-                   '\n *'.join(['%s (%s)' % (i[1], i[0]) for i in texthits if i[0]]) or '[None]')
+            \n___Text matches (& number of matches)___\n%s
+            ''' % (searchtext, '\n *'.join([i[0] for i in titlehits if i[1]]) or '[None]', textlist)
         else:
             self.autotext = '__New Search__'
-        return htmlize(self.autotext) + '''<form method="get" action="%s">
+        return self.html(self.autotext, after + '''<form method="get" action="%s">
         <p>Search for: 
         <input type="hidden" name="page" value="SiteSearch" />
         <input type="text" name="searchtext" value="%s" size="20" />
         <input type="submit" value="Submit" />
         <input type="reset" value="Reset" /></p></form>
-        ''' % (os.getenv('SCRIPT_NAME'), cgi.escape(searchtext, 1)) 
+        ''' % (os.getenv('SCRIPT_NAME'), escape(searchtext, 1)))
 
     def RecentChanges(self):
-        modlist = [(path.getmtime(path.join(PATH_TO_WIKI_TEXT, i)), i) for i in getwikipagelist()]
-        modlist.sort(); modlist.reverse()
-        modlist = modlist[:50]
+        if changejournal.exists():
+            #read one change more than is shown, to find whether there are older ones
+            try: skip = max(int(getattr(self.wikipage, 'skip', 0)), 0)
+            except ValueError: skip = 0 #not a number, so from the latest
+            changes = changejournal.tail(51, skip)
+            lines = []
+            for i in changes[:50]:
+                lines.append('%s   %s %sed' % (time.ctime(float(i[0])), i[1], i[2].rstrip('e')))
+                if i[4:]:
+                    lines[-1] += ' to ' + i[4]
+            self.autotext = '{{' + '\n'.join(lines) + '}}'
+            older = ''
+            if len(changes) > 50:
+                older = '<p><a href="%s">Older changes</a></p>' % escape(
+                    '%s?page=RecentChanges&skip=%s' % (os.getenv('SCRIPT_NAME'), skip + 50))
+            return self.html(self.autotext, older)
+        modlist = storage.recent(50)
         self.autotext = '{{' + '\n'.join([time.ctime(i[0]) + '   ' + i[1] for i in modlist]) + '}}'
-        return htmlize(self.autotext)
+        return self.html(self.autotext)
+
+    def RequestTimes(self):
+        times = {}
+        for when, label, ms in instrument.history():
+            times.setdefault(label, []).append(float(ms))
+        lines = ['%-20s %9s %9s %9s' % ('', 'requests', 'p50 (ms)', 'p95 (ms)')]
+        for label in sorted(times):
+            t = sorted(times[label])
+            lines.append('%-20s %9s %9.1f %9.1f'
+                         % (label, len(t), t[len(t) / 2], t[min(len(t) - 1, len(t) * 95 / 100)]))
+        if times:
+            self.autotext = '__Times taken by recent requests__\n{{' + '\n'.join(lines) + '}}'
+        else:
+            self.autotext = '__No request times have been recorded__'
+        return self.html(self.autotext)
+
+    def RenamePages(self):
+        renames = getattr(self.wikipage, 'renames', '')
+        if not EDITABLE:
+            return self.html('__Pages cannot be renamed here__')
+        if renames:
+            assert os.getenv('REQUEST_METHOD') == 'POST', 'only POST allowed'
+            renames = batchrename.parse(renames)
+            changed = batchrename.rename(renames)
+            self.autotext = '__%s pages renamed, and %s others changed to refer to them__\n *%s' % (
+                len(renames), changed,
+                '\n *'.join(['%s (was %s)' % (renames[i], i) for i in sorted(renames)]))
+        else:
+            self.autotext = '__Rename Pages__'
+        return self.html(self.autotext, '''<form method="post" action="%s">
+        <p>Pages to rename, one to a line, each as its old name and its new:<br />
+        <input type="hidden" name="page" value="RenamePages" />
+        <textarea name="renames" rows="10" cols="50"></textarea><br />
+        <input type="submit" value="Rename" />
+        <input type="reset" value="Reset" /></p></form>
+        ''' % os.getenv('SCRIPT_NAME'))
 
     def __str__(self):
         return getattr(self, self.wikipage.page)()
-    
-                                 
-def get_wp_args():
+
+    def stream(self):
+        'generate the page in chunks, as it is rendered'
+        self.streaming = True
+        r = getattr(self, self.wikipage.page)()
+        if isinstance(r, basestring):
+            r = [r]
+        for chunk in r:
+            yield chunk
+
+
+class BlockCache:
+    '''The HTML of the blocks of a page's text (see WikiParser.stream_blocks) as last rendered,
+    kept in PATH_TO_WIKI_DATA/blocks, by a hash of each block's text and the state in which it
+    was rendered. A block is not reused if any page it links to has since been created or
+    removed, and none are if the configuration on which rendering depends has changed. Only the
+    blocks of the latest rendering are kept'''
+    def __init__(self, page):
+        self.filename = path.join(PATH_TO_WIKI_DATA, 'blocks', page)
+        self.config = (NOFOLLOW_OUTLINKS, NUMBERED_OUTLINKS, REWRITE_MODE, REWRITE_BASE_URL,
+                       os.getenv('SCRIPT_NAME'), path.getmtime(__file__))
+        self.old, self.new, self.changed = None, {}, False
+
+    def load(self):
+        self.old = {}
+        try:
+            config, entries = marshal.load(file(self.filename, 'rb'))
+        except (IOError, EOFError, ValueError, TypeError):
+            return
+        if config == self.config:
+            self.old = entries
+
+    def get(self, key):
+        if self.old is None:
+            self.load()
+        entry = self.old.get(key)
+        if entry is None:
+            return None
+        for name, existcode in entry[-1]:
+            if pageregistry.existcode(name) != existcode:
+                return None
+        self.new[key] = entry
+        return entry
+
+    def __setitem__(self, key, entry):
+        self.new[key] = entry
+        self.changed = True
+
+    def save(self):
+        if self.changed or len(self.new) != len(self.old or {}):
+            try: os.mkdir(path.dirname(self.filename))
+            except OSError: pass #already made
+            atomic_write(self.filename, marshal.dumps((self.config, self.new)))
+
+    def discard(self):
+        if PATH_TO_WIKI_DATA and path.isfile(self.filename):
+            os.remove(self.filename)
+
+
+class CacheWriter:
+    '''Writes a page's HTML file for REWRITE_MODE 2 as the page is made, together with compressed
+    copies of it (if GZIP_LEVEL is set) for the web server to send instead to browsers which
+    accept them: gzip, and brotli if the module for it is installed. Each copy is made as small as
+    it can be, as this is done only when the page changes. The files all appear, complete, on
+    close (when any stale copy of the HTML file goes), and not at all if abort is called first'''
+    def __init__(self, filename):
+        self.filename = filename
+        copies = [(filename, str, lambda: '')] #(file, compression of a chunk, end of compression)
+        if GZIP_LEVEL:
+            import zlib
+            c = zlib.compressobj(9, zlib.DEFLATED, 31)
+            copies.insert(0, (filename + '.gz', c.compress, c.flush))
+            try:
+                import brotli
+                b = brotli.Compressor()
+            except (ImportError, AttributeError):
+                pass
+            else:
+                copies.insert(0, (filename + '.br', b.process, b.finish))
+        self.files = []
+        for name, compress, finish in copies:
+            tmpfile = '%s.%s.tmp' % (name, os.getpid())
+            self.files.append((name, tmpfile, file(tmpfile, 'wb'), compress, finish))
+
+    def write(self, data):
+        for name, tmpfile, f, compress, finish in self.files:
+            f.write(compress(data))
+
+    def close(self):
+        #the HTML file last, so that whenever it is there, so are current compressed copies
+        for name, tmpfile, f, compress, finish in self.files:
+            f.write(finish())
+            f.close()
+            os.rename(tmpfile, name)
+        self.files = []
+        if path.isfile(self.filename + '.stale'):
+            os.remove(self.filename + '.stale')
+
+    def abort(self):
+        for name, tmpfile, f, compress, finish in self.files:
+            f.close()
+            os.remove(tmpfile)
+        self.files = []
+
+
+class Macros:
+    '''Runs macro calls, [[name]] or [[name(arguments)]], where name is an attribute of the
+    mwmacros module and any arguments are literals. Each call is parsed once and dispatched
+    without eval. The calls in a page run together in a pool of threads, each allowed
+    MACRO_TIMEOUT seconds (or its function's 'timeout' attribute). A function with a 'cache_ttl'
+    attribute has its results kept for that many seconds (in PATH_TO_WIKI_DATA, if set, so that
+    they last beyond the process). A call which cannot be parsed, fails, or takes too long is
+    left in the page as a comment. A call taking too long runs on in its thread, so the pool is
+    left to it, and another started for later calls'''
+    threads = 8
+    placeholder_re = re.compile('\0M([0-9]+)\0')
+
+    def __init__(self):
+        self.calls, self.results, self.mtime = {}, {}, None
+        self.pool, self.pid = None, None
+
+    def parse(self, call):
+        '(name, args, kwargs) of a call, args being None for a bare name, or None if not valid'
+        if call not in self.calls:
+            import ast
+            self.calls[call] = None
+            try:
+                node = ast.parse(call.strip(), mode='eval').body
+                if isinstance(node, ast.Name):
+                    self.calls[call] = (node.id, None, None)
+                elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name)\
+                     and not (node.starargs or node.kwargs):
+                    self.calls[call] = (node.func.id, [ast.literal_eval(i) for i in node.args],
+                                        dict([(str(i.arg), ast.literal_eval(i.value))
+                                              for i in node.keywords]))
+            except (SyntaxError, ValueError):
+                pass
+        return self.calls[call]
+
+    def function(self, name):
+        module = lazy_import('mwmacros')
+        if module is None or name.startswith('_'):
+            return None
+        return getattr(module, name, None)
+
+    def run(self, calls):
+        'return the output of each of a list of calls (the text between [[ and ]]), None if failed'
+        results, jobs, running, start = [None] * len(calls), [], {}, time.time()
+        for n, call in enumerate(calls):
+            parsed = self.parse(call)
+            f = parsed and self.function(parsed[0])
+            if f is None:
+                continue
+            name, args, kwargs = parsed
+            if args is None:
+                results[n] = f
+            elif callable(f):
+                results[n] = self.cached(call)
+                if results[n] is not None:
+                    continue
+                if getattr(f, 'cache_ttl', 0) and call in running: #the same result will do
+                    jobs.append((n, call, f, running[call]))
+                else:
+                    running[call] = self.getpool().apply_async(f, args, kwargs)
+                    jobs.append((n, call, f, running[call]))
+        new = {}
+        for n, call, f, job in jobs:
+            try:
+                results[n] = job.get(max(0, start + getattr(f, 'timeout', MACRO_TIMEOUT) - time.time()))
+            except Exception:
+                if not job.ready(): #timed out
+                    self.abandon()
+                continue
+            if getattr(f, 'cache_ttl', 0) and results[n] is not None:
+                new[call] = (time.time() + f.cache_ttl, results[n])
+        if new:
+            self.store(new)
+        return results
+
+    def splice(self, html, calls, failed):
+        '''replace the placeholder for each call (the whole [[...]]) in html with its output, or
+        failed(call) if it has none'''
+        results = self.run([i[2:-2] for i in calls])
+        def output(match):
+            n = int(match.group(1))
+            if results[n] is None:
+                return failed(calls[n])
+            return results[n]
+        return self.placeholder_re.sub(output, html)
+
+    def getpool(self):
+        'the pool of threads, started afresh in a forked process'
+        if self.pid != os.getpid():
+            from multiprocessing.pool import ThreadPool
+            self.pool, self.pid = ThreadPool(self.threads), os.getpid()
+        return self.pool
+
+    def abandon(self):
+        'leave the pool to the calls running in it, its threads ending as they finish'
+        if self.pool is not None:
+            self.pool.close()
+        self.pool, self.pid = None, None
+
+    def filename(self):
+        return path.join(PATH_TO_WIKI_DATA, 'macros')
+
+    def cached(self, call):
+        'the cached result of a call, or None if there is none still good'
+        if PATH_TO_WIKI_DATA:
+            try: mtime = path.getmtime(self.filename())
+            except OSError: mtime = None
+            if mtime != self.mtime:
+                try: self.results = marshal.load(file(self.filename(), 'rb'))
+                except (IOError, EOFError, ValueError, TypeError): pass
+                self.mtime = mtime
+        expires, r = self.results.get(call, (0, None))
+        return (None, r)[expires > time.time()]
+
+    def store(self, results):
+        'add a dictionary of call: (time of expiry, result) to the cache, dropping expired results'
+        now = time.time()
+        self.results = dict([i for i in self.results.items() if i[1][0] > now])
+        self.results.update(results)
+        if PATH_TO_WIKI_DATA:
+            try: atomic_write(self.filename(), marshal.dumps(self.results))
+            except ValueError: return #results of a type which cannot be kept on disk
+            self.mtime = path.getmtime(self.filename())
+
+
+class Template:
+    '''A template compiled into its literal text and the code of each <!--#expression--> token,
+    so that it need not be parsed on every request. A token which fails to compile or evaluate
+    is left as it is'''
+    token_re = re.compile(r'<!--#(.+?)-->')
+
+    def __init__(self, text):
+        self.chunks = [] #literal text, and (token, code) pairs
+        pos = 0
+        for m in self.token_re.finditer(text):
+            self.chunks.append(text[pos:m.start()])
+            try:
+                #as eval does with strings, ignore leading spaces and tabs
+                self.chunks.append((m.group(0), compile(m.group(1).lstrip(' \t'), 'template', 'eval')))
+            except Exception:
+                self.chunks.append(m.group(0))
+            else:
+                for name in set(self.chunks[-1][1].co_names) & set(lazy_modules):
+                    lazy_import(name)
+            pos = m.end()
+        self.chunks.append(text[pos:])
+
+    def substitute(self, g, l):
+        r = []
+        for i in self.chunks:
+            if isinstance(i, str):
+                r.append(i)
+            else:
+                try: r.append(str(eval(i[1], g, l)))
+                except: r.append(i[0])
+        return ''.join(r)
+
+    def names(self):
+        '''the WikiNames in the strings in its tokens' code: the pages whose output it may include
+        (as <!--#WikiPage('OtherPage')--> does). Those only in its literal text it just mentions'''
+        r, codes = set(), [i[1] for i in self.chunks if not isinstance(i, str)]
+        while codes:
+            code = codes.pop()
+            for i in code.co_consts:
+                if isinstance(i, basestring):
+                    r.update(LinkIndex.link_re.findall(i))
+                elif hasattr(i, 'co_consts'): #code of a lambda or the like, within the token
+                    codes.append(i)
+        return r
+
+    def stream(self, g, l, contents):
+        '''generate what substitute gives for a page, l['self'], whose contents come in chunks from
+        a generator. What comes before the first token to use the contents is given first, and if
+        that token is just <!--#wiki--> or <!--#self.contents-->, the chunks are passed on as they
+        come. l['wiki'] and the page's contents are then set, for any later tokens'''
+        page, uses = l['self'], set(['wiki', 'contents'])
+        for n, i in enumerate(self.chunks):
+            if isinstance(i, str):
+                yield i
+                continue
+            if contents is not None and uses & set(i[1].co_names):
+                expression, kept = i[0][5:-3].strip(), []
+                later = [j for j in self.chunks[n + 1:]
+                         if not isinstance(j, str) and uses & set(j[1].co_names)]
+                if expression in ('wiki', 'self.contents'):
+                    if expression == 'wiki': yield page.header + '\n'
+                    yield '<div id="contents">'
+                    for chunk in contents:
+                        if later: kept.append(chunk)
+                        yield chunk
+                    yield '</div>'
+                    if expression == 'wiki': yield '\n' + page.footer
+                else:
+                    kept, later = list(contents), True
+                contents = None
+                if later:
+                    page.contents = '<div id="contents">%s</div>' % ''.join(kept)
+                    l['wiki'] = '\n'.join([page.header, page.contents, page.footer])
+                if expression in ('wiki', 'self.contents'):
+                    continue
+            try: yield str(eval(i[1], g, l))
+            except: yield i[0]
+
+
+class TemplateCache:
+    '''Compiled templates by name, each compiled again only if its file's modification time
+    changes. Names found to have no template are remembered until the template directory changes,
+    so that page-specific templates which do not exist are not looked for on every request'''
+    def __init__(self):
+        self.longstop = Template(WikiPage.longstop_template)
+        self.templates, self.missing, self.dirmtime = {}, set(), None
+
+    def get(self, name):
+        'return the compiled template of the given name, or None if there is none'
+        try: dirmtime = path.getmtime(PATH_TO_TEMPLATES)
+        except OSError: dirmtime = None
+        if dirmtime != self.dirmtime:
+            self.missing.clear()
+            self.dirmtime = dirmtime
+        if name in self.missing:
+            return None
+        filename = path.join(PATH_TO_TEMPLATES, name)
+        try:
+            mtime = path.getmtime(filename)
+            if self.templates.get(name, (None,))[0] != mtime:
+                self.templates[name] = (mtime, Template(file(filename).read()))
+        except (OSError, IOError):
+            self.missing.add(name)
+            self.templates.pop(name, None)
+            return None
+        return self.templates[name][1]
+
+
+class FileStorage:
+    '''Page text kept as one file per page in PATH_TO_WIKI_TEXT. Every storage has the methods
+    here; version() changes whenever pages are created or removed. Here it is the modification
+    time of versionfile, moved on only then (not that of PATH_TO_WIKI_TEXT, which every write
+    changes, as atomic_write renames a new file into it)'''
+    mmap_size = 256 * 1024 #pages of at least this many bytes are mapped into memory to search
+    def filename(self, page):
+        return path.join(PATH_TO_WIKI_TEXT, page)
+
+    def pages(self):
+        return [i for i in os.listdir(PATH_TO_WIKI_TEXT)
+                if path.isfile(self.filename(i)) and WikiName(i).is_valid()]
+
+    def exists(self, page):
+        return path.isfile(self.filename(page))
+
+    def read(self, page):
+        return file(self.filename(page)).read()
+
+    def buffer(self, page):
+        '''the text of a page as something regular expressions can search: for a large page the
+        file mapped into memory (which must be closed), so that it is read only as it is searched'''
+        f = file(self.filename(page), 'rb')
+        try:
+            if os.fstat(f.fileno()).st_size < self.mmap_size:
+                return f.read()
+            import mmap
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+    def readall(self):
+        'iterate over (page, text) of every page'
+        for page in self.pages():
+            yield page, self.read(page)
+
+    def write(self, page, text, mtime=None):
+        created = not self.exists(page)
+        atomic_write(self.filename(page), text, True)
+        if mtime is not None:
+            os.utime(self.filename(page), (mtime, mtime))
+        if created:
+            self.touch()
+
+    def writemany(self, pages):
+        'write each of a list of (page, text) or (page, text, mtime)'
+        for i in pages:
+            self.write(*i)
+
+    def remove(self, page):
+        os.remove(self.filename(page))
+        self.touch()
+
+    def replace(self, changes):
+        '''make all the changes in a dictionary of page: new text (None to remove the page), or
+        none of them. The new texts are written beside the pages, then a manifest of the changes,
+        and only then are they put in place, so that if this is interrupted the changes are either
+        forgotten or, if the manifest was written, finished by recover'''
+        lockfile = self.lock()
+        try:
+            self._recover()
+            for page, text in changes.items():
+                if text is not None:
+                    f = file(self.filename(page) + '.new', 'wb')
+                    try:
+                        f.write(text)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    finally:
+                        f.close()
+            sync_directory(PATH_TO_WIKI_TEXT)
+            atomic_write(self.manifest(),
+                         marshal.dumps([(i, changes[i] is not None) for i in changes]), True)
+            self._recover()
+        finally:
+            lockfile.close()
+
+    def manifest(self):
+        return path.join(PATH_TO_WIKI_DATA or PATH_TO_WIKI_TEXT, 'replacing')
+
+    def recover(self):
+        '''finish the changes of an interrupted replace, or wait for one under way to finish.
+        Done whenever the version is looked at (as it is first for every request) if there is a
+        manifest, so that no page is read while only some of the changes have been made'''
+        lockfile = self.lock()
+        try:
+            self._recover()
+        finally:
+            lockfile.close()
+
+    def lock(self):
+        'the file holding the lock on replacing pages, which is released when it is closed'
+        import fcntl
+        lockfile = file(self.manifest() + '.lock', 'w')
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        return lockfile
+
+    def _recover(self):
+        '''finish the changes of an interrupted replace if its manifest was written, otherwise
+        remove any new texts it left'''
+        try:
+            changes = marshal.load(file(self.manifest(), 'rb'))
+        except IOError:
+            changes = []
+        created = False
+        for page, present in changes:
+            if not present:
+                if self.exists(page): self.remove(page)
+            elif path.isfile(self.filename(page) + '.new'): #otherwise already in place
+                created = created or not self.exists(page)
+                os.rename(self.filename(page) + '.new', self.filename(page))
+        if changes:
+            sync_directory(PATH_TO_WIKI_TEXT)
+            if created: self.touch()
+            os.remove(self.manifest())
+        for i in os.listdir(PATH_TO_WIKI_TEXT):
+            if i.endswith('.new') and WikiName(i[:-4]).is_valid():
+                os.remove(self.filename(i))
+
+    def mtime(self, page):
+        return path.getmtime(self.filename(page))
+
+    def size(self, page):
+        return path.getsize(self.filename(page))
+
+    def recent(self, count):
+        'the count most recently modified pages, latest first, as (modification time, page)'
+        r = [(self.mtime(i), i) for i in self.pages()]
+        r.sort(); r.reverse()
+        return r[:count]
+
+    def versionfile(self):
+        return path.join(PATH_TO_WIKI_DATA or PATH_TO_WIKI_TEXT, 'pagesversion')
+
+    def touch(self):
+        '''move the version on, as pages have been created or removed (run by reindex, for pages
+        changed other than through the wiki). As in SQLiteStorage, it always moves on, even if the
+        clock goes back'''
+        try: t = max(time.time(), path.getmtime(self.versionfile()) + 0.001)
+        except OSError:
+            file(self.versionfile(), 'a').close()
+            t = time.time()
+        os.utime(self.versionfile(), (t, t))
+
+    def version(self):
+        if path.exists(self.manifest()):
+            self.recover()
+        try: return path.getmtime(self.versionfile())
+        except OSError: pass
+        try: self.touch() #made by the first request
+        except (IOError, OSError): return path.getmtime(PATH_TO_WIKI_TEXT) #cannot be made here
+        return path.getmtime(self.versionfile())
+
+
+class SQLiteStorage:
+    '''Page text, modification time and size kept in a single SQLite database, PATH_TO_WIKI_DB, so
+    that listing pages, looking for one, or finding the latest changed, is a query of an index
+    rather than a look at every file'''
+    schema = '''create table if not exists pages
+                  (name text primary key, text text, mtime real, size integer);
+               create index if not exists pages_mtime on pages (mtime);
+               create table if not exists meta (name text primary key, value integer);
+               insert or ignore into meta values ('version', 0);'''
+
+    def __init__(self):
+        self.connection, self.pid = None, None
+
+    def db(self):
+        'connection to the database, opened afresh in a forked process'
+        if self.pid != os.getpid():
+            import sqlite3
+            self.connection = sqlite3.connect(PATH_TO_WIKI_DB, timeout=30)
+            self.connection.text_factory = str #pages are bytes, as in files
+            self.connection.executescript(self.schema)
+            self.pid = os.getpid()
+        return self.connection
+
+    def query(self, sql, *args):
+        return self.db().execute(sql, args).fetchall()
+
+    def pages(self):
+        return [i[0] for i in self.query('select name from pages')]
+
+    def exists(self, page):
+        return bool(self.query('select 1 from pages where name = ?', page))
+
+    def read(self, page):
+        r = self.query('select text from pages where name = ?', page)
+        if not r:
+            raise IOError, 'No such page: %s' % page
+        return r[0][0]
+
+    def buffer(self, page):
+        return self.read(page)
+
+    def readall(self):
+        return self.db().execute('select name, text from pages')
+
+    def writemany(self, pages):
+        '''write each of a list of (page, text) or (page, text, mtime) in a single transaction,
+        so that either all are written or none'''
+        db = self.db()
+        with db:
+            for i in pages:
+                self.put(db, *i)
+
+    def put(self, db, page, text, mtime=None):
+        'write a page, within a transaction on db'
+        mtime = mtime or time.time()
+        if not db.execute('update pages set text = ?, mtime = ?, size = ? where name = ?',
+                          (text, mtime, len(text), page)).rowcount:
+            db.execute('insert into pages values (?, ?, ?, ?)', (page, text, mtime, len(text)))
+            self.changed(db)
+
+    def write(self, page, text, mtime=None):
+        self.writemany([(page, text, mtime)])
+
+    def remove(self, page):
+        db = self.db()
+        with db:
+            if not db.execute('delete from pages where name = ?', (page,)).rowcount:
+                raise OSError, 'No such page: %s' % page
+            self.changed(db)
+
+    def recover(self):
+        'nothing to do, as replace is a single transaction'
+
+    def replace(self, changes):
+        '''make all the changes in a dictionary of page: new text (None to remove the page), in a
+        single transaction'''
+        db = self.db()
+        with db:
+            for page, text in changes.items():
+                if text is not None:
+                    self.put(db, page, text)
+                elif db.execute('delete from pages where name = ?', (page,)).rowcount:
+                    self.changed(db)
+
+    def touch(self):
+        'move the version on, as in FileStorage'
+        db = self.db()
+        with db:
+            self.changed(db)
+
+    def changed(self, db):
+        #as a time, but always moving on, so that it can be a version even if the clock goes back
+        db.execute("update meta set value = max(value + 0.000001, ?) where name = 'version'",
+                   (time.time(),))
+
+    def mtime(self, page):
+        r = self.query('select mtime from pages where name = ?', page)
+        if not r:
+            raise OSError, 'No such page: %s' % page
+        return r[0][0]
+
+    def size(self, page):
+        r = self.query('select size from pages where name = ?', page)
+        if not r:
+            raise OSError, 'No such page: %s' % page
+        return r[0][0]
+
+    def recent(self, count):
+        return self.query('select mtime, name from pages order by mtime desc limit ?', count)
+
+    def version(self):
+        return self.query("select value from meta where name = 'version'")[0][0]
+
+
+class TemplateIndex:
+    '''The pages whose output each template may include (see Template.names), taken again from a
+    template only when its modification time changes, and kept in PATH_TO_WIKI_DATA if set, so
+    that finding the templates which include a page does not mean reading them all'''
+    def __init__(self):
+        self.data = None #template: (modification time, names)
+
+    def filename(self):
+        return path.join(PATH_TO_WIKI_DATA, 'templates')
+
+    def templates(self):
+        try: return os.listdir(PATH_TO_TEMPLATES)
+        except OSError: return []
+
+    def includers(self, page):
+        'the templates which may include the page'
+        data = self.load()
+        return [i for i in self.templates() if page in data.get(i, (None, []))[1]]
+
+    def names(self, template):
+        'the pages which the template may include'
+        return self.load().get(template, (None, []))[1]
+
+    def load(self):
+        'the data, brought up to date with the templates'
+        if self.data is None:
+            self.data = {}
+            if PATH_TO_WIKI_DATA:
+                try: self.data = marshal.load(file(self.filename(), 'rb'))
+                except (IOError, EOFError, ValueError, TypeError): pass
+        templates, changed = self.templates(), False
+        for name in set(self.data) - set(templates):
+            del self.data[name]
+            changed = True
+        for name in templates:
+            try: mtime = path.getmtime(path.join(PATH_TO_TEMPLATES, name))
+            except OSError: continue
+            if self.data.get(name, (None,))[0] != mtime:
+                t = templatecache.get(name)
+                self.data[name] = (mtime, sorted(t and t.names() or []))
+                changed = True
+        if changed and PATH_TO_WIKI_DATA:
+            atomic_write(self.filename(), marshal.dumps(self.data))
+        return self.data
+
+
+class PageRegistry:
+    '''Which pages exist, taken from a single listing of the pages in storage plus the names of
+    the AutoPages, so that linking to a page needs no look at the disk. The listing is taken again
+    whenever the storage's version shows that pages have been created or removed'''
+    def __init__(self):
+        self.autopages = [i for i in dir(AutoPage) if WikiName(i).is_valid()]
+        self.pages, self.mtime = set(), None
+        self.sitelinks = {} #(SCRIPT_NAME, AutoPage): link to it
+
+    def refresh(self):
+        mtime = storage.version()
+        if mtime != self.mtime:
+            self.pages = set(storage.pages())
+            self.mtime = mtime
+
+    def existcode(self, page):
+        'as WikiPage.existcode'
+        if page in self.autopages:
+            return 2
+        if self.mtime is None:
+            self.refresh()
+        return int(page in self.pages)
+
+    def get_href(self, page):
+        'href of a link to the page, which is to edit it if it does not exist'
+        return get_href(page, ('edit', 'goto')[self.existcode(page) > 0])
+
+    def sitelink(self, page):
+        'HTML of a link to the page for the footer, made only once for each AutoPage'
+        key = (os.getenv('SCRIPT_NAME'), page)
+        r = self.sitelinks.get(key)
+        if r is None:
+            r = '<a href="%s">%s</a>' % (escape(self.get_href(page)), WikiName(page).spacify())
+            if page in self.autopages:
+                self.sitelinks[key] = r
+        return r
+
+    def add(self, page):
+        self.pages.add(page)
+
+    def discard(self, page):
+        self.pages.discard(page)
+
+
+class ChangeJournal:
+    '''Record of changes to pages, kept in PATH_TO_WIKI_DATA. Each change is appended as a line of
+    tab-separated fields: time, page, action, client address and (for a rename) the new name'''
+    def filename(self):
+        return path.join(PATH_TO_WIKI_DATA, 'journal')
+
+    def exists(self):
+        return bool(PATH_TO_WIKI_DATA) and path.isfile(self.filename())
+
+    def record(self, page, action, *details):
+        if not PATH_TO_WIKI_DATA: return
+        line = '\t'.join(['%.0f' % time.time(), page, action, client_address()] + list(details))
+        #a single write in append mode, so that lines from concurrent requests are not mixed
+        fd = os.open(self.filename(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, line + '\n')
+        finally:
+            os.close(fd)
+
+    def tail(self, count, skip=0):
+        '''return up to count changes (each a list of fields), latest first, after skipping the
+        latest skip. The journal is read backwards from its end only as far as is needed'''
+        f = file(self.filename(), 'rb')
+        f.seek(0, 2)
+        pos, buf = f.tell(), ''
+        while pos > 0 and buf.count('\n') <= count + skip:
+            n = min(pos, 16384)
+            pos -= n
+            f.seek(pos)
+            buf = f.read(n) + buf
+        f.close()
+        lines = buf.split('\n')[(pos > 0):]   #first line may be incomplete
+        lines = [i for i in lines if i]
+        lines.reverse()
+        return [i.split('\t') for i in lines[skip:skip + count]]
+
+
+class PageLock:
+    '''Context manager holding an exclusive lock on each of a list of pages while they are
+    changed, so that changes to a page are made one after another rather than losing each
+    other's. The locks are taken in order of name, a lock already held by this thread is not
+    taken again, and if they cannot all be had within timeout seconds an error is raised. Readers
+    take no lock: a page's text is always replaced whole (see atomic_write), never changed in place.
+    Every change also holds a shared lock on the whole wiki, except one of more than many pages
+    (a rename of a page many others link to, say), which holds it alone, exclusively, so as not
+    to keep a file open for each page. The lock files are kept in PATH_TO_WIKI_DATA/locks, or
+    PATH_TO_WIKI_TEXT/locks'''
+    timeout = 10
+    many = 64
+    wiki = 'allpages' #the name of the lock on the whole wiki (which no page can have)
+    held = {} #thread: the pages whose locks it holds, and '' or wiki if it holds the wiki's
+
+    def __init__(self, pages):
+        import fcntl, thread
+        held = self.held.setdefault(thread.get_ident(), set())
+        pages = sorted(set(pages) - held)
+        if self.wiki in held or not pages:
+            self.locks = []
+        elif len(pages) > self.many:
+            assert '' not in held, 'Cannot lock the whole wiki while changing a page'
+            self.locks = [(self.wiki, fcntl.LOCK_EX)]
+        else:
+            self.locks = [(i, fcntl.LOCK_EX) for i in pages]
+            if '' not in held:
+                self.locks.insert(0, ('', fcntl.LOCK_SH))
+        self.files = []
+
+    def __enter__(self):
+        import fcntl, thread
+        dirname = path.join(PATH_TO_WIKI_DATA or PATH_TO_WIKI_TEXT, 'locks')
+        try: os.mkdir(dirname)
+        except OSError: pass #already made
+        deadline = time.time() + self.timeout
+        held = self.held[thread.get_ident()]
+        for name, mode in self.locks:
+            f = file(path.join(dirname, name or self.wiki), 'w')
+            self.files.append(f)
+            while True:
+                try:
+                    fcntl.flock(f, mode | fcntl.LOCK_NB)
+                    break
+                except IOError:
+                    if time.time() > deadline:
+                        self.__exit__()
+                        raise Exception, '%s being changed by someone else: please try again'\
+                              % (name in ('', self.wiki) and 'Pages are' or "The page '%s' is"
+                                 % name)
+                    time.sleep(0.05)
+            held.add(name)
+
+    def __exit__(self, *exc_info):
+        import thread
+        for f in self.files:
+            f.close()
+        held = self.held[thread.get_ident()]
+        held.difference_update([i[0] for i in self.locks])
+        if not held:
+            del self.held[thread.get_ident()]
+
+
+class PageHistory:
+    '''Every revision of each page, kept in PATH_TO_WIKI_DATA/history/page. Each revision is
+    appended to the file as a marshalled tuple of time, action, client address, note, kind and
+    data, where kind is 's' for a snapshot of the whole text (compressed), 'd' for a delta from the
+    revision before (the lines kept from it, and those added, compressed) or 'x' for the page
+    having gone. A snapshot is taken every snapshot_every revisions, so that no revision is more
+    than that many deltas from one, and whenever a delta would be no smaller. Beside the file is
+    an index (page.index) of the offset and kind of each revision, in entries of entry_size
+    bytes, so that a revision is found by seeking to the snapshot before it, without reading the
+    rest. A renamed page's history stays under its old name, ending there and beginning afresh
+    under the new'''
+    snapshot_every = 10
+    entry_size = 9 #an offset, as an unsigned long long, and a kind
+
+    def filename(self, page):
+        return path.join(PATH_TO_WIKI_DATA, 'history', page)
+
+    def exists(self, page):
+        return bool(PATH_TO_WIKI_DATA) and path.isfile(self.filename(page))
+
+    def purge(self, page):
+        'remove the history of a page, returning the number of revisions it had'
+        files = self.open(page)
+        if not files: return 0
+        try:
+            count = self.entries(files[1])
+            for i in files:
+                os.remove(i.name)
+            return count
+        finally:
+            self.close(files)
+
+    def open(self, page, create=False):
+        '''the history file of a page and its index, open and locked, the index brought up to date
+        with any revisions added without it (by a crash, or before there were indexes). None if
+        the page has no history, unless create is set'''
+        import fcntl
+        if create:
+            try: os.mkdir(path.dirname(self.filename(page)))
+            except OSError: pass #already made
+        elif not self.exists(page):
+            return None
+        f = file(self.filename(page), 'a+b')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        index = file(self.filename(page) + '.index', 'a+b')
+        count = self.entries(index)
+        f.seek(count and self.entry(index, count)[0] or 0)
+        if count:
+            marshal.load(f) #the last revision indexed
+        if f.tell() < os.fstat(f.fileno()).st_size:
+            index.truncate(count * self.entry_size) #any partly written entry
+            while True:
+                offset = f.tell()
+                try: revision = marshal.load(f)
+                except EOFError: break
+                index.write(self.pack(offset, revision[4]))
+            index.flush()
+        return f, index
+
+    def close(self, files):
+        for i in files or []:
+            i.close()
+
+    def pack(self, offset, kind):
+        import struct
+        return struct.pack('<Qc', offset, kind)
+
+    def entries(self, index):
+        'the number of revisions in an index'
+        return os.fstat(index.fileno()).st_size / self.entry_size
+
+    def entry(self, index, rev):
+        'the offset and kind of revision rev (counting from 1)'
+        import struct
+        index.seek((rev - 1) * self.entry_size)
+        return struct.unpack('<Qc', index.read(self.entry_size))
+
+    def read(self, f, index, first, last):
+        'revisions first to last'
+        f.seek(self.entry(index, first)[0])
+        return [marshal.load(f) for i in range(first, last + 1)]
+
+    def start(self, index, rev):
+        'the revision from which revision rev is rebuilt: the latest not a delta, up to it'
+        while rev > 1 and self.entry(index, rev)[1] == 'd':
+            rev -= 1
+        return rev
+
+    def revisions(self, page, first=1, last=None):
+        '''a list of (time, action, client, note, kind) of revisions first to last (by default, the
+        latest) of a page, earliest first'''
+        files = self.open(page)
+        if not files: return []
+        try:
+            last = min(last or self.entries(files[1]), self.entries(files[1]))
+            if first > last: return []
+            return [i[:5] for i in self.read(files[0], files[1], first, last)]
+        finally:
+            self.close(files)
+
+    def count(self, page):
+        'the number of revisions of a page'
+        files = self.open(page)
+        try: return files and self.entries(files[1]) or 0
+        finally: self.close(files)
+
+    def text(self, page, rev):
+        'the text of revision rev (counting from 1) of a page, None if the page had gone'
+        files = self.open(page)
+        if not files: return None
+        try:
+            f, index = files
+            if not 0 < rev <= self.entries(index): return None
+            return self.rebuild(self.read(f, index, self.start(index, rev), rev))
+        finally:
+            self.close(files)
+
+    def find(self, page, token):
+        '''the text of the latest revision of a page with the given token (see text_token), or None.
+        The revisions are rebuilt a snapshot at a time from the latest, only as far back as is
+        needed'''
+        files = self.open(page)
+        if not files: return None
+        try:
+            f, index = files
+            end = self.entries(index)
+            while end > 0:
+                start, lines, r = self.start(index, end), None, None
+                for revision in self.read(f, index, start, end):
+                    lines = self.step(lines, revision)
+                    if lines is not None and text_token('\n'.join(lines)) == token:
+                        r = '\n'.join(lines)
+                if r is not None:
+                    return r
+                end = start - 1
+            return None
+        finally:
+            self.close(files)
+
+    def rebuild(self, revisions):
+        'the text of the last of a list of revisions, from the last snapshot and deltas after it'
+        start = len(revisions) - 1
+        while start > 0 and revisions[start][4] == 'd':
+            start -= 1
+        lines = None
+        for revision in revisions[start:]:
+            lines = self.step(lines, revision)
+        return lines and '\n'.join(lines)
+
+    def step(self, lines, revision):
+        'the lines of the text of a revision, given those of the revision before'
+        import zlib
+        kind, data = revision[4:]
+        if kind == 's':
+            return zlib.decompress(data).split('\n')
+        elif kind == 'd':
+            r = []
+            for i in marshal.loads(zlib.decompress(data)):
+                if isinstance(i, tuple):
+                    r.extend(lines[i[0]:i[1]]) #lines kept
+                else:
+                    r.extend(i) #lines added
+            return r
+        return None
+
+    def record(self, page, action, text, old=None, note='', oldtime=None):
+        '''add a revision of a page, with the text it now has (None if it has gone). old is the
+        text it had before, which is kept first if it has no history yet, as of oldtime (by
+        default the time the page was last modified, for a page not yet changed)'''
+        if not PATH_TO_WIKI_DATA: return
+        import zlib, difflib
+        files = self.open(page, True)
+        try:
+            f, index = files
+            count = self.entries(index)
+            if not count and old is not None:
+                mtime = oldtime
+                if mtime is None:
+                    try: mtime = storage.mtime(page)
+                    except (IOError, OSError): mtime = time.time()
+                self.append(files, (mtime, 'original', '', '', 's', zlib.compress(old)))
+                count = 1
+            last = None
+            if count:
+                start = self.start(index, count)
+                last = self.rebuild(self.read(f, index, start, count))
+            if text is None:
+                kind, data = 'x', None
+            else:
+                kind, data = 's', zlib.compress(text)
+                if last is not None and count - start < self.snapshot_every - 1:
+                    a, b, ops = last.split('\n'), text.split('\n'), []
+                    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(
+                            None, a, b, False).get_opcodes():
+                        if tag == 'equal':
+                            ops.append((i1, i2))
+                        elif j2 > j1:
+                            ops.append(b[j1:j2])
+                    delta = zlib.compress(marshal.dumps(ops))
+                    if len(delta) < len(data):
+                        kind, data = 'd', delta
+            self.append(files, (time.time(), action, client_address(), note, kind, data))
+        finally:
+            self.close(files)
+
+    def append(self, files, revision):
+        'add a revision to the end of a history file, and to its index'
+        f, index = files
+        f.seek(0, 2)
+        offset = f.tell()
+        marshal.dump(revision, f)
+        f.flush()
+        index.write(self.pack(offset, revision[4]))
+        index.flush()
+
+
+class BackupSpool:
+    '''Backups waiting to be sent, one file per change in PATH_TO_WIKI_DATA/spool, so that saving a
+    page does not wait for the mail server. The 'sendbackups' command sends them. A file which
+    cannot be read as a backup is renamed to end '.bad', and left for someone to look at, rather
+    than stopping the others being sent'''
+    def dirname(self):
+        return path.join(PATH_TO_WIKI_DATA, 'spool')
+
+    def add(self, record):
+        if not path.isdir(self.dirname()):
+            try: os.mkdir(self.dirname())
+            except OSError: pass #made meanwhile by another request
+        atomic_write(path.join(self.dirname(), '%.6f-%s' % (time.time(), os.getpid())),
+                     marshal.dumps(record))
+
+    def flush(self, sender):
+        'send all spooled backups as one message, returning how many there were'
+        if not path.isdir(self.dirname()):
+            return 0
+        names = [path.join(self.dirname(), i) for i in sorted(os.listdir(self.dirname()))
+                 if not i.endswith('.tmp') and not i.endswith('.bad')]
+        records, sent = [], []
+        for i in names:
+            try:
+                record = marshal.load(file(i, 'rb'))
+                if not isinstance(record, dict) \
+                   or not set(['page', 'action', 'notification']) <= set(record):
+                    raise ValueError, 'not a backup'
+            except (IOError, EOFError, ValueError, TypeError):
+                os.rename(i, i + '.bad')
+                continue
+            records.append(record)
+            sent.append(i)
+        if records:
+            sender.send(records)
+            for i in sent:
+                os.remove(i)
+        return len(records)
+
+
+class BackupSender:
+    '''Emails backups, as a single message for any number of them. The connection to SMTP_SERVER
+    is kept open between sends, and made again (up to retries times in all, with increasing
+    pauses) on failure'''
+    retries = 4
+
+    def __init__(self, retries=None):
+        self.server = None
+        self.retries = retries or self.retries
+
+    def message(self, records):
+        import email.MIMEMultipart, email.MIMEText
+        notification = '\n'.join([i['notification'] for i in records])
+        if len(records) == 1 and 'text' not in records[0]:
+            m = email.MIMEText.MIMEText(notification)
+        else:
+            m = email.MIMEMultipart.MIMEMultipart()
+            m.attach(email.MIMEText.MIMEText(notification))
+            for i in records:
+                if 'text' in i:
+                    att = email.MIMEText.MIMEText(i['text'])
+                    att.add_header('Content-Disposition', 'attachment', filename=i['page'])
+                    m.attach(att)
+            m.epilogue = ''
+        if len(records) == 1:
+            subject = '%s %s' % (records[0]['page'], records[0]['action'])
+        else:
+            subject = '%s wiki changes' % len(records)
+        m['From'], m['To'], m['Subject'] = WIKI_LOGGER, WIKI_MASTER, subject
+        return m
+
+    def send(self, records):
+        import smtplib, socket
+        m = self.message(records).as_string()
+        for attempt in range(self.retries):
+            try:
+                if self.server is None:
+                    self.server = smtplib.SMTP(SMTP_SERVER)
+                self.server.sendmail(WIKI_LOGGER, [WIKI_MASTER], m)
+                return
+            except (smtplib.SMTPException, socket.error):
+                self.close()
+                if attempt == self.retries - 1:
+                    raise
+                time.sleep(2 ** attempt)
+
+    def close(self):
+        if self.server is not None:
+            try: self.server.quit()
+            except Exception: pass
+            self.server = None
+
+
+class Instrument:
+    '''Timings of the phases of a request, and counts of its file accesses, for when INSTRUMENT is
+    on. Phases are marked in the code by "with instrument.phase(name):" (time inside a phase
+    nested in another of the same name counts once). While a request is being instrumented the os
+    functions in 'counted' are replaced by wrappers which count their calls'''
+    counted = [(path, 'isfile'), (path, 'getmtime'), (os, 'listdir')]
+    history_size = 10000 #number of requests' timings kept in PATH_TO_WIKI_DATA
+
+    def __init__(self):
+        self.active, self.summary = False, ''
+
+    def begin(self):
+        self.active, self.start = True, time.time()
+        self.times, self.depth, self.counts = {}, {}, {}
+        self.originals = [(i, name, getattr(i, name)) for i, name in self.counted]
+        for i, name, f in self.originals:
+            setattr(i, name, self.counter(name, f))
+
+    def counter(self, name, f):
+        def counted(*args):
+            self.count(name)
+            return f(*args)
+        return counted
+
+    def count(self, name, n=1):
+        if self.active:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def end(self, label):
+        'finish timing a request, given a label for it (normally its action)'
+        for i, name, f in self.originals:
+            setattr(i, name, f)
+        self.active = False
+        total = (time.time() - self.start) * 1000
+        self.summary = '; '.join(
+            ['%s %.1fms' % i for i in [('total', total)] + sorted(self.times.items())]
+            + ['%s %s' % i for i in sorted(self.counts.items())])
+        if PATH_TO_WIKI_DATA:
+            self.record(label, total)
+
+    def filename(self):
+        return path.join(PATH_TO_WIKI_DATA, 'requesttimes')
+
+    def record(self, label, ms):
+        fd = os.open(self.filename(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, '%.0f\t%s\t%.1f\n' % (time.time(), label, ms))
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+        #when the file has grown to (roughly) twice its intended size, cut it back
+        if size > self.history_size * 60:
+            atomic_write(self.filename(), ''.join(self.history_lines()[-self.history_size:]))
+
+    def history_lines(self):
+        try: return file(self.filename()).readlines()
+        except IOError: return []
+
+    def history(self):
+        'recorded requests, as (time, label, milliseconds) from oldest to latest'
+        return [i.split('\t') for i in self.history_lines() if i.count('\t') == 2]
+
+
+class Phase:
+    'context manager adding the time spent inside it to one of the phases timed by an Instrument'
+    def __init__(self, instrument, name):
+        self.instrument, self.name = instrument, name
+
+    def __enter__(self):
+        i = self.instrument
+        if i.active:
+            i.depth[self.name] = i.depth.get(self.name, 0) + 1
+            self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        i = self.instrument
+        if i.active and self.name in i.depth:
+            i.depth[self.name] -= 1
+            if not i.depth[self.name]:
+                i.times[self.name] = i.times.get(self.name, 0) + (time.time() - self.start) * 1000
+
+
+class RenderCache:
+    'least recently used cache of rendered pages, holding at most size of them'
+    def __init__(self, size):
+        from collections import OrderedDict
+        self.size, self.pages = size, OrderedDict()
+
+    def get(self, key):
+        r = self.pages.pop(key, None)
+        if r is not None:
+            self.pages[key] = r
+        return r
+
+    def __setitem__(self, key, value):
+        self.pages[key] = value
+        while len(self.pages) > self.size:
+            self.pages.popitem(last=False)
+
+
+class WikiIndex:
+    '''Base for the indexes kept on disk in PATH_TO_WIKI_DATA, each an SQLite database holding
+    rows for each page, so that a change to a page changes only its rows, without reading or
+    writing the rest of the index. A subclass names its file, gives the schema of its tables
+    (besides meta, which records that the index has been built) and provides empty(), add() and
+    discard() to change its rows, all of them or one page's. Changes are made in a transaction
+    begun at once, so that what it reads cannot change before it writes. The index is built
+    from the pages the first time it is needed (or by the 'reindex' command)'''
+    name = None
+    schema = None
+
+    def __init__(self):
+        self.connections = {} #(process, thread): connection
+
+    def enabled(self):
+        return bool(PATH_TO_WIKI_DATA)
+
+    def filename(self):
+        return path.join(PATH_TO_WIKI_DATA, self.name)
+
+    def db(self):
+        '''connection to the index, one for each thread, opened afresh in a forked process, and
+        the index built if it has not been'''
+        import thread
+        key = os.getpid(), thread.get_ident()
+        if key not in self.connections:
+            import sqlite3
+            db = sqlite3.connect(self.filename(), timeout=30, isolation_level=None)
+            db.text_factory = str #pages are bytes
+            schema = self.schema
+            if sqlite3.sqlite_version_info < (3, 8, 2): #tables keyed by rowid as well, so bigger
+                schema = schema.replace(' without rowid', '')
+            db.executescript(schema + '''
+                create table if not exists meta (name text primary key, value integer);''')
+            self.connections[key] = db
+            if not db.execute("select 1 from meta where name = 'built'").fetchall():
+                self.rebuild()
+        return self.connections[key]
+
+    def transaction(self, f):
+        'call f with the connection to the index, within a transaction'
+        db = self.db()
+        db.execute('begin immediate')
+        try:
+            f(db)
+        except:
+            db.execute('rollback')
+            raise
+        db.execute('commit')
+
+    def rebuild(self):
+        def rebuild(db):
+            self.empty(db)
+            for page, text in storage.readall():
+                self.add(db, page, text)
+            db.execute("insert or replace into meta values ('built', 1)")
+        self.transaction(rebuild)
+
+    def replace(self, db, page, text):
+        self.discard(db, page)
+        if text is not None:
+            self.add(db, page, text)
+
+    def update(self, changes):
+        '''changes is a dictionary of page: new text, where text of None means the page has
+        gone'''
+        def update(db):
+            for page, text in changes.items():
+                self.replace(db, page, text)
+        self.transaction(update)
+
+
+class LinkIndex(WikiIndex):
+    '''Forward (page -> WikiNames in its text, in order of first appearance) and backward
+    (WikiName -> pages whose text contains it) links. The serial number changes whenever any
+    page's links change (including by its creation or deletion, or the index being rebuilt)'''
+    name = 'links.db'
+    schema = '''create table if not exists forward (page text primary key, links text);
+                create table if not exists backward (name text, page text,
+                                                     primary key (name, page)) without rowid;'''
+    link_re = re.compile(r'\b%s\b' % WikiName.re)
+
+    def empty(self, db):
+        db.execute('delete from forward')
+        db.execute('delete from backward')
+        self.changed(db)
+
+    def replace(self, db, page, text):
+        old = self.forward_links(db, page)
+        WikiIndex.replace(self, db, page, text)
+        if self.forward_links(db, page) != old:
+            self.changed(db)
+
+    def changed(self, db):
+        db.execute("insert or replace into meta values ('serial', "
+                   "coalesce((select value from meta where name = 'serial'), 0) + 1)")
+
+    def add(self, db, page, text):
+        links = []
+        for name in self.link_re.findall(text):
+            if name not in links:
+                links.append(name)
+        db.execute('insert into forward values (?, ?)', (page, ' '.join(links)))
+        db.executemany('insert into backward values (?, ?)', [(i, page) for i in links])
+
+    def discard(self, db, page):
+        links = self.forward_links(db, page)
+        if links is not None:
+            db.execute('delete from forward where page = ?', (page,))
+            db.executemany('delete from backward where name = ? and page = ?',
+                           [(i, page) for i in links])
+
+    def forward_links(self, db, page):
+        'the links of a page, or None if it is not indexed'
+        r = db.execute('select links from forward where page = ?', (page,)).fetchall()
+        if not r:
+            return None
+        return r[0][0].split()
+
+    def links(self, page):
+        return self.forward_links(self.db(), page) or []
+
+    def forward(self):
+        'a dictionary of every page: its links, as links() gives them'
+        return dict([(page, links.split())
+                     for page, links in self.db().execute('select page, links from forward')])
+
+    def referers(self, page):
+        return [i[0] for i in self.db().execute('select page from backward where name = ?',
+                                                (page,))]
+
+    def serial(self):
+        r = self.db().execute("select value from meta where name = 'serial'").fetchall()
+        return r and r[0][0] or 0
+
+
+class SiteMapCache:
+    '''Rendered maps (see AutoPage.SiteMap), by top page, kept until the link index's serial
+    number shows that some page's links have changed. The map of the whole site is also kept on
+    disk, for processes started afresh'''
+    def __init__(self):
+        self.maps = RenderCache(20)
+
+    def get(self, top_page, render):
+        'return the map from top_page, calling render() to make it if there is none'
+        cachefile, serial = path.join(PATH_TO_WIKI_DATA, 'sitemap'), linkindex.serial()
+        r = self.maps.get((top_page, serial))
+        if r is None and top_page == FRONT_PAGE:
+            try: cached = marshal.load(file(cachefile, 'rb')) #(serial, map)
+            except (IOError, EOFError, ValueError, TypeError): cached = None
+            if cached and cached[0] == serial:
+                r = cached[1]
+        if r is None:
+            r = render()
+            if top_page == FRONT_PAGE:
+                atomic_write(cachefile, marshal.dumps((serial, r)))
+        self.maps[(top_page, serial)] = r
+        return r
+
+
+class TermIndex(WikiIndex):
+    '''Postings of each word (lower case) to the pages containing it, with the number of times
+    it occurs in each. A search for a word, or for alternative words (a|b|c), looks up just
+    those words, so finds the pages containing them as whole words (where reading the pages
+    would also find them within longer words)'''
+    name = 'terms.db'
+    schema = '''create table if not exists pages (id integer primary key, page text unique,
+                                                  terms text);
+                create table if not exists postings (term text, page integer, count integer,
+                                                     primary key (term, page)) without rowid;'''
+    term_re = re.compile(r'\w+')
+    searchable_re = re.compile(r'^\w+(\|\w+)*$')
+
+    def enabled(self):
+        return bool(PATH_TO_WIKI_DATA and SEARCH_INDEX)
+
+    def empty(self, db):
+        db.execute('delete from pages')
+        db.execute('delete from postings')
+
+    def add(self, db, page, text):
+        counts = {}
+        for term in self.term_re.findall(text.lower()):
+            counts[term] = counts.get(term, 0) + 1
+        #postings refer to pages by number, as that takes less room than the name
+        n = db.execute('insert into pages (page, terms) values (?, ?)',
+                       (page, ' '.join(counts))).lastrowid
+        db.executemany('insert into postings values (?, ?, ?)',
+                       [(term, n, count) for term, count in counts.iteritems()])
+
+    def discard(self, db, page):
+        r = db.execute('select id, terms from pages where page = ?', (page,)).fetchall()
+        if r:
+            db.execute('delete from pages where id = ?', (r[0][0],))
+            db.executemany('delete from postings where term = ? and page = ?',
+                           [(i, r[0][0]) for i in r[0][1].split()])
+
+    def pages(self):
+        return [i[0] for i in self.db().execute('select page from pages')]
+
+    def can_search(self, searchtext):
+        return self.searchable_re.match(searchtext) is not None
+
+    def search(self, searchtext):
+        'return a dictionary of page: number of matches, for pages with any'
+        p = re.compile(searchtext, re.I)
+        db, r = self.db(), {}
+        for term in set(searchtext.lower().split('|')):
+            n = len(p.findall(term))
+            for page, count in db.execute('select pages.page, count from postings join pages'
+                                          ' on postings.page = id where term = ?', (term,)):
+                r[page] = r.get(page, 0) + n * count
+        return r
+
+
+class RegexSearch:
+    '''Searches for a regular expression that the word index cannot answer, by reading every
+    page. The pages are shared out in batches among SEARCH_PROCESSES processes, each giving, as
+    it finishes a batch, the number of matches in each page and a snippet of the text around the
+    first. The processes are only started for a process serving request after request, which
+    keeps them for the next search, or for at least pool_pages pages: for fewer, starting them
+    takes longer than a CGI script reading the pages itself. The search stops early once
+    SEARCH_TIME_LIMIT seconds have passed, and ranks what it has found'''
+    batch = 64 #pages given to a process at a time
+    context = 40 #characters of text shown either side of a match
+    pool_pages = 4000 #about 0.04ms each to read, against 0.12s to start the processes
+    resident = False #set by application, when the processes started are kept for later requests
+
+    def __init__(self):
+        self.pool, self.pid = None, None
+
+    def getpool(self):
+        'the pool of processes, started afresh in a forked process'
+        if self.pid != os.getpid():
+            from multiprocessing import Pool
+            self.pool, self.pid = Pool(SEARCH_PROCESSES), os.getpid()
+        return self.pool
+
+    def search(self, searchtext, pages):
+        '''a list of (number of matches, page, snippet) of the pages matching, most matches first,
+        the number of pages searched, and whether the search stopped before searching them all'''
+        from multiprocessing import TimeoutError
+        batches = [(searchtext, pages[i:i + self.batch]) for i in range(0, len(pages), self.batch)]
+        deadline = SEARCH_TIME_LIMIT and time.time() + SEARCH_TIME_LIMIT
+        pooled = SEARCH_PROCESSES > 1 and len(batches) > 1 \
+                 and (self.resident or len(pages) >= self.pool_pages)
+        if pooled:
+            results = self.getpool().imap_unordered(scan_pages, batches)
+            get = lambda: results.next(deadline and max(deadline - time.time(), 0.001) or None)
+        else:
+            results = itertools.imap(scan_pages, batches)
+            get = results.next
+        hits, searched, done = [], 0, 0
+        try:
+            while done < len(batches):
+                if deadline and time.time() > deadline:
+                    break
+                n, batchhits = get()
+                searched, done = searched + n, done + 1
+                hits.extend(batchhits)
+        except TimeoutError:
+            pass
+        if pooled and done < len(batches):
+            #its processes are still busy with the rest, so start others for the next search
+            self.pool.terminate()
+            self.pool, self.pid = None, None
+        hits.sort(key=lambda i: (-i[0], i[1]))
+        return hits, searched, done < len(batches)
+
+    def snippet(self, text, match):
+        'HTML of the text around a match in it, the match highlighted'
+        start, end = match.span()
+        def show(s):
+            return escape(re.sub(r'\s+', ' ', s))
+        return '%s%s<strong>%s</strong>%s%s' % (
+            ('', '...')[start > self.context], show(text[max(start - self.context, 0):start]),
+            show(text[start:min(end, start + 2 * self.context)]),
+            show(text[end:end + self.context]), ('', '...')[end + self.context < len(text)])
+
+
+class BatchRename:
+    '''Renames of many pages at once, given as a dictionary of old name: new name, the pages which
+    refer to them being changed to refer to them by their new names. The pages referring to their
+    old or new names are found from the link index (or by reading every page), and found again
+    once they are locked. Each is rewritten once, by a single pass of the regular expression for
+    WikiNames, in batches shared among SEARCH_PROCESSES processes if there are many. The changes
+    are then stored all together or not at all (see replace in FileStorage and SQLiteStorage),
+    and the history, indexes and saved HTML of pages brought up to date once, when they all
+    have been'''
+    batch = 512 #pages given to a process at a time: fewer are quicker to rewrite than start one
+
+    def parse(self, text):
+        'the renames in text, each on a line as an old name and a new one'
+        r = {}
+        for line in text.splitlines():
+            names = line.split()
+            if not names:
+                continue
+            if len(names) != 2:
+                raise Exception, 'Each line must be an old name and a new one: %s' % line
+            if names[0] in r:
+                raise Exception, 'The page %s is renamed twice' % names[0]
+            r[names[0]] = names[1]
+        return r
+
+    def referers(self, names):
+        'the set of pages whose text refers to any of the names'
+        if linkindex.enabled():
+            r = set()
+            for i in names:
+                r.update(linkindex.referers(i))
+            return r
+        names = set(names)
+        return set([page for page, text in storage.readall()
+                    if names.intersection(LinkIndex.link_re.findall(text))])
+
+    def check(self, renames):
+        'raise an exception if the renames cannot all be made'
+        for old, new in sorted(renames.items()):
+            for i in old, new:
+                assert WikiName(i).is_valid(), 'Invalid WikiName: %s' % i
+            if not storage.exists(old):
+                raise Exception, "The page '%s' does not exist" % old
+            if hasattr(AutoPage, new) or storage.exists(new) and new not in renames:
+                raise Exception, 'Cannot overwrite %s page %s'\
+                      % (('existing', 'automatic')[hasattr(AutoPage, new)], new)
+        if len(set(renames.values())) < len(renames):
+            raise Exception, 'Cannot rename two pages to the same name'
+
+    def rewrite(self, renames, pages):
+        '''a dictionary of page: (text, new text, old names replaced) of each of the pages whose
+        text refers to any of the renamed pages'''
+        batches = [(renames, pages[i:i + self.batch]) for i in range(0, len(pages), self.batch)]
+        if SEARCH_PROCESSES > 1 and len(batches) > 1:
+            from multiprocessing import Pool
+            pool = Pool(min(SEARCH_PROCESSES, len(batches)))
+            try:
+                results = pool.map(rewrite_pages, batches)
+            finally:
+                pool.terminate()
+        else:
+            results = map(rewrite_pages, batches)
+        return dict([(i[0], i[1:]) for i in itertools.chain(*results)])
+
+    def rename(self, renames):
+        '''rename pages, given a dictionary of old name: new name (and no more than one to each
+        name, though a new name may be one of the old). Returns the number of other pages
+        changed to refer to them'''
+        renames = dict([i for i in renames.items() if i[0] != i[1]])
+        if not renames:
+            return 0
+        #pages referring to the new names too, whose links to them will change
+        names = renames.keys() + renames.values()
+        referers = self.referers(names)
+        while True:
+            with PageLock(names + list(referers)):
+                #a page may have been saved referring to them before the locks were had
+                found = self.referers(names)
+                if found <= referers:
+                    return self.apply(renames, found)
+            referers |= found
+
+    def apply(self, renames, referers):
+        '''rename pages, as rename does, holding the locks on them and on the pages referring to
+        their old or new names, referers'''
+        self.check(renames)
+        rewritten = self.rewrite(renames, sorted(referers))
+        for old in renames:
+            if old not in rewritten:
+                text = storage.read(old)
+                rewritten[old] = (text, text, [])
+        changes = dict.fromkeys(renames)
+        for page in rewritten:
+            if page not in renames:
+                changes[page] = rewritten[page][1]
+        for old, new in renames.items():
+            changes[new] = rewritten[old][1]
+        #when each page was last modified, for the history of those which have none yet
+        mtimes = dict([(i, storage.mtime(i)) for i in rewritten])
+        storage.replace(changes)
+        #only now that the changes have been made are they recorded
+        for old, new in sorted(renames.items()):
+            WikiPage(old, 'rename', newname=new).backup()
+            pagehistory.record(old, 'rename', None, rewritten[old][0], 'to ' + new, mtimes[old])
+        for page, (text, newtext, found) in sorted(rewritten.items()):
+            if page not in renames:
+                pagehistory.record(page, 'rename', newtext, text, 'of ' + ', '.join(
+                    ['%s to %s' % (i, renames[i]) for i in found]), mtimes[page])
+        for old, new in sorted(renames.items()):
+            pagehistory.record(new, 'rename', changes[new], None, 'from ' + old)
+        for old, new in renames.items():
+            pageregistry.discard(old)
+            if old not in renames.values():
+                BlockCache(old).discard()
+        for new in renames.values():
+            pageregistry.add(new)
+        reindex_pages(changes)
+        for old, new in sorted(renames.items()):
+            changejournal.record(old, 'rename', new)
+        self.invalidate(renames, referers)
+        return len([i for i in rewritten if i not in renames])
+
+    def invalidate(self, renames, referers):
+        '''for REWRITE_MODE 2, remove the saved HTML of the renamed pages, and of the pages whose
+        output they may change: referers, and those which include them through templates'''
+        if REWRITE_MODE != 2:
+            return
+        names = set(renames) | set(renames.values())
+        pages = set(referers)
+        for i in names:
+            pages.update(WikiPage(i).get_includers())
+        for page in pages | names:
+            WikiPage(page).kill_HTMLfile(page in renames.values() or page not in renames)
+
+
+class Command:
+    '''Command line entry points, run as "monkeywiki.py command [arguments]". The existence of a
+    method here (not starting with _) defines a command'''
+
+    def serve(self, port='8000', processes='4'):
+        'serve the wiki over HTTP on the given port, from the given number of processes'
+        from wsgiref.simple_server import make_server
+        #wsgiref says its server is multithreaded, though it handles one request at a time
+        server = make_server('', int(port), lambda environ, start_response: application(
+            dict(environ, **{'wsgi.multithread': False}), start_response))
+        #the processes share the listening socket, each taking the next request it can
+        for i in range(int(processes) - 1):
+            if os.fork() == 0:
+                break
+        server.serve_forever()
+
+    def prerender(self, mode='all', processes='4'):
+        '''write the HTML file of every page for REWRITE_MODE 2, or with mode 'incremental' only
+        of pages whose text, template or links have changed since the last run, using the given
+        number of processes. DOCUMENT_ROOT and SCRIPT_NAME must be set in the environment'''
+        assert REWRITE_MODE == 2, 'REWRITE_MODE is not 2'
+        assert os.getenv('DOCUMENT_ROOT'), 'DOCUMENT_ROOT is not set'
+        assert mode in ('all', 'incremental'), "mode must be 'all' or 'incremental'"
+        from multiprocessing import Pool
+        signatures, done = dict([(i, self._signature(i)) for i in getwikipagelist()]), {}
+        manifest = path.join(PATH_TO_WIKI_DATA, 'prerendered')
+        if mode == 'incremental':
+            assert PATH_TO_WIKI_DATA, 'PATH_TO_WIKI_DATA is not set'
+            try: done = marshal.load(file(manifest, 'rb'))
+            except (IOError, EOFError, ValueError): pass
+        pages = [i for i in signatures if signatures[i] != done.get(i)
+                 or not path.isfile(WikiPage(i).HTMLfile)]
+        pool = Pool(int(processes))
+        for page, error in pool.imap_unordered(prerender_page, pages, 16):
+            if error:
+                print '%s: %s' % (page, error)
+                signatures[page] = None
+        pool.close()
+        pool.join()
+        if PATH_TO_WIKI_DATA:
+            atomic_write(manifest, marshal.dumps(signatures))
+        print '%s of %s pages rendered' % (len(pages), len(signatures))
+
+    def _signature(self, page):
+        'the things on which the HTML of a page depends, to tell whether it needs rendering again'
+        if linkindex.enabled():
+            links = linkindex.links(page)
+        else:
+            links = LinkIndex.link_re.findall(storage.read(page))
+        r = [storage.mtime(page), storage.size(page)]
+        for i in [page, 'default']:
+            try: r.append(path.getmtime(path.join(PATH_TO_TEMPLATES, i)))
+            except OSError: r.append(None)
+        return tuple(r + [(i, pageregistry.existcode(i)) for i in links])
+
+    def sendbackups(self, interval='0'):
+        '''email the backups spooled in PATH_TO_WIKI_DATA as one message or, given an interval in
+        seconds, keep doing so at that interval'''
+        sender, interval = BackupSender(), float(interval)
+        while True:
+            try:
+                n = backupspool.flush(sender)
+                if n: print '%s: sent %s backups' % (time.ctime(), n)
+            except Exception, inst:
+                if not interval: raise
+                print '%s: sending backups failed (%s), will retry' % (time.ctime(), inst)
+            if not interval: break
+            time.sleep(interval)
+        sender.close()
+
+    def cgistub(self, filename):
+        '''write a CGI script, filename, which imports and runs this one, so that Python can keep it
+        compiled (as the .pyc file beside it) rather than compiling it for every request, as it does
+        a script run directly. This script must have a name ending in .py'''
+        import py_compile
+        source = path.abspath(sys.argv[0])
+        name, ext = path.splitext(path.basename(source))
+        assert ext == '.py', 'This script must have a name ending in .py to be imported'
+        py_compile.compile(source, doraise=True) #in case the web server cannot write the .pyc
+        file(filename, 'w').write('#!%s\nimport sys\nsys.path.insert(0, %r)\nimport %s\n%s.main()\n'
+                                  % (sys.executable, path.dirname(source), name, name))
+        os.chmod(filename, 0755)
+        print 'wrote %s, to run %s' % (filename, source)
+
+    def migrate(self, to='sqlite'):
+        '''copy every page, with its modification time, from the storage STORAGE is not to the
+        given one ('files' or 'sqlite'). Set STORAGE to it afterwards'''
+        stores = {'files': FileStorage(), 'sqlite': SQLiteStorage()}
+        assert to in stores, "storage must be 'files' or 'sqlite'"
+        source, destination = stores[('sqlite', 'files')[to == 'sqlite']], stores[to]
+        pages = source.pages()
+        destination.writemany([(i, source.read(i), source.mtime(i)) for i in pages])
+        print '%s pages copied to %s' % (len(pages), to)
+
+    def renamepages(self, filename='-'):
+        '''rename many pages at once, as the RenamePages page does, given a file (or - for the
+        standard input) of lines each of an old name and a new one. With REWRITE_MODE 2,
+        DOCUMENT_ROOT and SCRIPT_NAME must be set in the environment'''
+        assert REWRITE_MODE != 2 or os.getenv('DOCUMENT_ROOT'), 'DOCUMENT_ROOT is not set'
+        os.environ.setdefault('DOCUMENT_ROOT', '') #from which the pages' HTML files are named
+        renames = batchrename.parse((filename == '-' and sys.stdin or file(filename)).read())
+        changed = batchrename.rename(renames)
+        print '%s pages renamed, and %s others changed to refer to them' % (len(renames), changed)
+
+    def purgehistory(self, page):
+        '''remove every revision of a page kept in PATH_TO_WIKI_DATA (of spam, or of text that
+        should not have been saved, say), leaving the page as it is'''
+        assert PATH_TO_WIKI_DATA, 'PATH_TO_WIKI_DATA is not set'
+        assert WikiName(page).is_valid(), 'Invalid WikiName: %s' % page
+        print '%s revisions of %s removed' % (pagehistory.purge(page), page)
+
+    def reindex(self):
+        'rebuild the indexes in PATH_TO_WIKI_DATA from the page files'
+        assert PATH_TO_WIKI_DATA, 'PATH_TO_WIKI_DATA is not set'
+        storage.recover() #so as not to index pages partly renamed
+        storage.touch() #for any pages created or removed other than through the wiki
+        for i in wikiindexes:
+            if i.enabled(): i.rebuild()
+
+    def __call__(self, name, *args):
+        if name.startswith('_') or not hasattr(self, name):
+            print 'Usage: %s command [arguments]\nCommands:' % sys.argv[0]
+            for i in dir(self):
+                if not i.startswith('_'):
+                    print '  %-12s %s' % (i, getattr(self, i).__doc__)
+            sys.exit(2)
+        getattr(self, name)(*args)
+
+
+def escape(s, quote=False):
+    '''s with the characters special in HTML replaced by entities (and double quotes, if quote is
+    set), as cgi.escape does, without the cost of importing cgi'''
+    s = s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    if quote:
+        s = s.replace('"', '&quot;')
+    return s
+
+
+#modules imported only when first needed, to start quickly
+lazy_modules = ('cgi', 'mwmacros')
+
+def lazy_import(name):
+    '''the module of the given name (one of lazy_modules), imported into the globals, where
+    templates can use it. None if it cannot be imported, as the optional mwmacros may not be'''
+    if name not in globals():
+        try: globals()[name] = __import__(name)
+        except Exception: globals()[name] = None
+    return globals()[name]
+
+
+def atomic_write(filename, data, sync=False):
+    '''replace the contents of filename without any reader ever seeing a partly written file, and
+    if sync is set, making sure the new contents are on disk (so will survive a crash) first'''
+    tmpfile = '%s.%s.tmp' % (filename, os.getpid())
+    f = file(tmpfile, 'wb')
+    try:
+        f.write(data)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(tmpfile, filename)
+    if sync:
+        sync_directory(path.dirname(filename) or '.') #the rename itself
+
+
+def sync_directory(dirname):
+    'make sure that the files created, renamed and removed in a directory are so on disk'
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def text_token(text):
+    'a token of a revision of a page, given its text (None if it does not exist)'
+    if text is None:
+        return ''
+    import hashlib
+    return hashlib.md5(text).hexdigest()
+
+
+def merge(base, mine, theirs):
+    '''merge two lists of lines, each changed from the base list of lines. Returns the merged
+    lines, in which where both changed the same lines each version is shown between conflict
+    markers, and the number of such conflicts'''
+    import difflib
+    hunks = [] #(start, end, lines replacing base[start:end], which list)
+    for n, other in enumerate([mine, theirs]):
+        for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, base, other, False).get_opcodes():
+            if tag != 'equal':
+                hunks.append((i1, i2, other[j1:j2], n))
+    hunks.sort()
+    def version(hunks, start, end):
+        r, pos = [], start
+        for i1, i2, lines, n in hunks:
+            r += base[pos:i1] + lines
+            pos = i2
+        return r + base[pos:end]
+    r, pos, conflicts, i = [], 0, 0, 0
+    while i < len(hunks):
+        #a run of changes which overlap or touch
+        start, end, j = hunks[i][0], hunks[i][1], i + 1
+        while j < len(hunks) and hunks[j][0] <= end:
+            end = max(end, hunks[j][1])
+            j += 1
+        run = hunks[i:j]
+        mine_v = version([h for h in run if h[3] == 0], start, end)
+        theirs_v = version([h for h in run if h[3] == 1], start, end)
+        r += base[pos:start]
+        if mine_v == theirs_v or not [h for h in run if h[3] == 1]:
+            r += mine_v
+        elif not [h for h in run if h[3] == 0]:
+            r += theirs_v
+        else:
+            r += ['<<<<<<< yours'] + mine_v + ['======='] + theirs_v + ['>>>>>>> theirs']
+            conflicts += 1
+        pos, i = end, j
+    return r + base[pos:], conflicts
+
+
+def htmldiff(old, new):
+    'HTML of a unified diff between two lists of lines, lines added and removed marked as such'
+    import difflib
+    lines = []
+    for line in list(difflib.unified_diff(old, new, lineterm=''))[2:]:
+        tag = {'+': 'ins', '-': 'del'}.get(line[:1])
+        lines.append(tag and '<%s>%s</%s>' % (tag, escape(line), tag) or escape(line))
+    return '<pre class="diff">%s</pre>' % ('\n'.join(lines) or '[None]')
+
+
+def gzipped(data, level):
+    import zlib
+    c = zlib.compressobj(level, zlib.DEFLATED, 31) #31: with a gzip header and trailer
+    return c.compress(data) + c.flush()
+
+
+def gzip_stream(chunks, level):
+    'gzip chunks of data, giving out what can be sent of it after each'
+    import zlib
+    c = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        yield c.compress(chunk) + c.flush(zlib.Z_SYNC_FLUSH)
+    yield c.flush()
+
+
+def accepts(encoding):
+    'whether the request\'s Accept-Encoding header allows the response to be in the given encoding'
+    for i in os.getenv('HTTP_ACCEPT_ENCODING', '').lower().split(','):
+        name, params = (i.split(';', 1) + [''])[:2]
+        if name.strip() == encoding:
+            q = re.search(r'q\s*=\s*([0-9.]+)', params)
+            try: return not q or float(q.group(1)) > 0
+            except ValueError: return False
+    return False
+
+
+def gzipping():
+    'whether encode will gzip the response: if GZIP_LEVEL is set and the browser accepts it'
+    return bool(GZIP_LEVEL) and accepts('gzip')
+
+
+def encode(r, headers):
+    '''r (a string, or a generator of chunks of one) gzipped if GZIP_LEVEL is set and the browser
+    accepts it, adding to headers to say so'''
+    if not GZIP_LEVEL:
+        return r
+    headers.append(('Vary', 'Accept-Encoding'))
+    if gzipping():
+        headers.append(('Content-Encoding', 'gzip'))
+        if isinstance(r, str):
+            r = gzipped(r, GZIP_LEVEL)
+        else:
+            r = gzip_stream(r, GZIP_LEVEL)
+    return r
+
+
+def prerender_page(page):
+    '''write the HTML file of a page, as a REWRITE_MODE 2 visit to it would (for the process pool of
+    the 'prerender' command). Returns the page and an error message if it failed'''
+    try:
+        w = WikiPage(page, 'goto')
+        w.web_output()
+    except Exception, inst:
+        return page, str(inst) or inst.__class__.__name__
+    return page, None
+
+
+def scan_pages(args):
+    '''search each of a batch of pages for a regular expression (for the process pool of
+    RegexSearch), given as a tuple of the expression and the pages. Returns the number of pages
+    and a list of (number of matches, page, snippet) of those matching'''
+    searchtext, pages = args
+    p, hits = re.compile(searchtext, re.I + re.M), []
+    for page in pages:
+        try: text = storage.buffer(page)
+        except (IOError, OSError): continue #removed since the search began
+        count, first = 0, None
+        for match in p.finditer(text):
+            count += 1
+            first = first or match
+        if count:
+            hits.append((count, page, regexsearch.snippet(text, first)))
+        if not isinstance(text, str):
+            text.close()
+    return len(pages), hits
+
+
+def rewrite_pages(args):
+    '''put the new names of renamed pages into each of a batch of pages (for the process pool of
+    BatchRename), given as a tuple of a dictionary of old name: new name and the pages. Returns a
+    list of (page, text, new text, old names replaced) of those which refer to any of them'''
+    renames, r = args[0], []
+    def rename(match):
+        name = match.group()
+        if name not in renames:
+            return name
+        found.add(name)
+        return renames[name]
+    for page in args[1]:
+        try: text = storage.read(page)
+        except (IOError, OSError): continue #removed since the pages were found
+        found = set()
+        newtext = LinkIndex.link_re.sub(rename, text)
+        if found:
+            r.append((page, text, newtext, sorted(found)))
+    return r
+
+
+def reindex_pages(changes):
+    'bring all indexes up to date with a dictionary of page: new text (None if deleted)'
+    for i in wikiindexes:
+        if i.enabled():
+            i.update(changes)
+
+
+def get_wp_args(fp=None, environ=None):
     argdict = {'page': FRONT_PAGE} #default
 
-    form = cgi.FieldStorage()
+    environ = environ or os.environ
+    if environ.get('REQUEST_METHOD', 'GET') in ('GET', 'HEAD'):
+        #there is only the query string, which is quicker to parse without importing cgi
+        from urlparse import parse_qsl
+        argdict.update(parse_qsl(environ.get('QUERY_STRING', '')))
+        return argdict
+    form = lazy_import('cgi').FieldStorage(fp, environ=environ)
     for k in form.keys():
         argdict[k] = form[k].value
 
     return argdict
 
 
+def client_address():
+    return os.getenv('HTTP_X_FORWARDED_FOR', os.getenv('REMOTE_ADDR', '[unknown]'))
+
+
+def get_href(page, action):
+    if REWRITE_MODE and action == 'goto':
+        r = path.join(REWRITE_BASE_URL, page + '.html')
+    else:
+        r = '%s?page=%s' % (os.getenv('SCRIPT_NAME'), page)
+        if action != 'goto':
+            r += '&action=' + action
+    return r
+
+
 def getwikipagelist():
-    return [i for i in os.listdir(PATH_TO_WIKI_TEXT)\
-            if path.isfile(path.join(PATH_TO_WIKI_TEXT, i)) and WikiName(i).is_valid()]
+    return storage.pages()
 
 
-def main():
-    print 'Content-Type: text/html; charset=iso-8859-1\n'
+def respond(fp=None, environ=None, cache=None, stream=False):
+    '''return the HTTP status, any headers beyond the Content-Type, and the full wiki page for a
+    request or, if stream is set, a generator of chunks of it as it is made. A long-running
+    process can pass a RenderCache, in which the output of 'goto' for ordinary pages is kept for
+    reuse'''
+    if INSTRUMENT: instrument.begin()
+    label, status, headers = 'error', '200 OK', []
     try:
-        wikipage = WikiPage(**get_wp_args())
+        pageregistry.refresh()
+        wikipage = WikiPage(**get_wp_args(fp, environ))
+        label = (wikipage.action, wikipage.page)[wikipage.existcode == 2]
         #set environment variable for use by any ancillary scripts (e.g. macros)
         #that might require a route back to the current wiki page 
         os.environ['WIKIPAGE_URI'] = 'http://%s%s' % (
             os.environ['SERVER_NAME'],
             WikiPage(wikipage.page, 'goto').get_href())
-        #emit full wiki page
-        print wikipage.web_output()
+        r = None
+        if wikipage.action == 'goto' and wikipage.existcode == 1:
+            version = wikipage.get_version()
+            if version is not None:
+                etag, lastmodified = validators(version)
+                headers = [('ETag', etag), ('Last-Modified', http_date(lastmodified)),
+                           ('Cache-Control', 'no-cache')] #always ask, as the page can change
+                if not_modified(etag, lastmodified):
+                    label, status, r = 'not modified', '304 Not Modified', ''
+            if r is None and REWRITE_MODE == 2:
+                r = wikipage.claim_render()
+                if wikipage.stale:
+                    #not the version the validators are of, so not to be kept under them
+                    headers = [('Cache-Control', 'no-store')]
+            if r is None and cache is not None and version is not None:
+                r = cache.get((wikipage.page, version))
+                if r is not None and wikipage.render_lock:
+                    wikipage.write_HTMLfile(r) #claimed, so it is for this process to write
+                if r is None and stream:
+                    return status, headers, streamed(wikipage.web_stream(), label,
+                                                     cache, (wikipage.page, version))
+                if r is None:
+                    r = cache[(wikipage.page, version)] = wikipage.web_output()
+        if r is None and stream:
+            return status, headers, streamed(wikipage.web_stream(), label)
+        if r is None:
+            r = wikipage.web_output()
     except Exception, inst:
-        print 'Error:', inst
+        status, headers, r = '200 OK', [], 'Error: %s' % inst
+    if INSTRUMENT: instrument.end(label)
+    return status, headers, r
+
+
+def streamed(chunks, label, cache=None, key=None):
+    '''pass on the chunks of a page, then finish as respond does, keeping the whole page in cache
+    under key if given. An error part of the way through ends the page with its message'''
+    kept = []
+    try:
+        for chunk in chunks:
+            if cache is not None: kept.append(chunk)
+            yield chunk
+        if cache is not None: cache[key] = ''.join(kept)
+    except Exception, inst:
+        yield 'Error: %s' % inst
+    if INSTRUMENT: instrument.end(label)
+
+
+def validators(version):
+    '''ETag and modification time of the output of 'goto' for an ordinary page, given its
+    get_version, or rather of this version of it from this version of the script (and so of
+    its configuration). The ETag of a gzipped page ends '-gz', as its bytes differ from those
+    of the page sent as it is'''
+    import hashlib
+    version += (path.getmtime(__file__),)
+    etag = '"%s%s"' % (hashlib.md5(repr(version)).hexdigest()[:16], ('', '-gz')[gzipping()])
+    return etag, max([i for i in version if i is not None])
+
+
+def not_modified(etag, lastmodified):
+    'whether the request is for the page only if it has changed from what the client already has'
+    if os.getenv('REQUEST_METHOD', 'GET') not in ('GET', 'HEAD'):
+        return False
+    tags = os.getenv('HTTP_IF_NONE_MATCH')
+    if tags is not None: #takes precedence over If-Modified-Since
+        tags = [i.strip() for i in tags.split(',')]
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+    since = os.getenv('HTTP_IF_MODIFIED_SINCE')
+    if since:
+        from rfc822 import parsedate_tz, mktime_tz #much quicker to import than email.utils
+        since = parsedate_tz(since.split(';')[0])
+        return since is not None and int(lastmodified) <= mktime_tz(since)
+    return False
+
+
+def http_date(t):
+    'the time t as HTTP gives times, in English whatever the locale'
+    year, month, day, hour, minute, second, weekday = time.gmtime(t)[:7]
+    return '%s, %02d %s %04d %02d:%02d:%02d GMT' % (
+        ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')[weekday], day,
+        ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')[month - 1],
+        year, hour, minute, second)
+
+
+def main():
+    #stream unless timing requests, whose phases are timed as web_output makes the whole page
+    status, headers, r = respond(stream=not INSTRUMENT)
+    if status != '304 Not Modified':
+        #full wiki page, sent as it is made
+        r = encode(page_end(r), headers)
+    print 'Content-Type: text/html; charset=iso-8859-1'
+    if status != '200 OK':
+        print 'Status: ' + status
+    for i in headers:
+        print '%s: %s' % i
+    print
+    for chunk in r:
+        sys.stdout.write(chunk)
+        sys.stdout.flush()
+
+
+def page_end(r):
+    'the chunks of a page as main sends it, with what follows it'
+    if isinstance(r, str):
+        r = [r]
+    for chunk in r:
+        yield chunk
+    yield '\n'
+    if INSTRUMENT: yield '<!-- %s -->\n' % instrument.summary
+
+
+base_environ = dict(os.environ)
+
+def application(environ, start_response):
+    '''WSGI entry point, for serving the wiki from long-running processes (for example with the
+    'serve' command) instead of starting the script afresh for every request as CGI does. Each
+    process must serve one request at a time, not several in threads'''
+    #the wiki (and any macros) expect to find the request's CGI variables in the environment, so
+    #give each request the process's original environment plus its own variables: which is why
+    #threads, sharing the one environment, cannot serve requests at once
+    assert not environ.get('wsgi.multithread'), \
+           'The wiki must be served by processes each handling one request at a time, not threads'
+    os.environ.clear()
+    os.environ.update(base_environ)
+    os.environ.update([(k, v) for k, v in environ.items() if isinstance(v, str)])
+    regexsearch.resident = True
+    #stream unless timing requests, which are given in a header so must be done before the page
+    status, headers, r = respond(environ['wsgi.input'], environ, rendercache, not INSTRUMENT)
+    headers.append(('Content-Type', 'text/html; charset=iso-8859-1'))
+    if status != '304 Not Modified':
+        r = encode(r, headers)
+    if isinstance(r, str):
+        headers.append(('Content-Length', str(len(r))))
+        r = [r]
+    if INSTRUMENT: headers.append(('X-Request-Timing', instrument.summary))
+    start_response(status, headers)
+    return r
+
+
+def htmlize(text):
+    'turn wiki text into HTML, with a parser of its own so that no state is shared between calls'
+    with instrument.phase('htmlize'):
+        return WikiParser()(text)
 
-htmlize = WikiParser()
+storage = {'files': FileStorage, 'sqlite': SQLiteStorage}[STORAGE]()
+rendercache = RenderCache(RENDER_CACHE_SIZE)
+pageregistry = PageRegistry()
+templatecache = TemplateCache()
+templateindex = TemplateIndex()
+changejournal = ChangeJournal()
+pagehistory = PageHistory()
+backupspool = BackupSpool()
+instrument = Instrument()
+sitemapcache = SiteMapCache()
+macros = Macros()
+regexsearch = RegexSearch()
+batchrename = BatchRename()
+linkindex = LinkIndex()
+termindex = TermIndex()
+wikiindexes = [linkindex, termindex]
 
-if __name__ == '__main__': main()
+if __name__ == '__main__':
+    #a web server may pass a query string without '=' to a CGI script as arguments, so commands
+    #are only taken from the command line when not running as one
+    if sys.argv[1:] and 'GATEWAY_INTERFACE' not in os.environ:
+        Command()(*sys.argv[1:])
+    else:
+        main()
 
@@ -0,0 +1,227 @@
+#!/usr/bin/python
+
+''' Benchmarks for MonkeyWiki
+
+    Generates a synthetic wiki (deterministically, from a seed) of each of the requested sizes
+    in a temporary directory, times the main operations of monkeywiki.py on it, and writes the
+    results as JSON so that runs before and after a change can be compared:
+
+        python mwbench.py --sizes 1000,10000 --output after.json --compare before.json
+
+    Run "python mwbench.py --help" for the other options.'''
+
+import os, sys, re, time, random, shutil, tempfile, json, subprocess
+from os import path
+from optparse import OptionParser
+
+import monkeywiki
+
+WORDS = ('the monkey wiki page text with some words about things that are written here and '
+         'there for testing of parser speed on ordinary prose').split()
+
+
+class Corpus:
+    '''A synthetic wiki: pages named BenchPage0, BenchPage1... whose text mixes paragraphs, lists,
+    {{ }} pre blocks, emphasis, macros, external links and links to other pages (and to some that
+    do not exist), plus a default template and a few page-specific ones'''
+    def __init__(self, pages, page_size=2000, link_density=0.05, seed=0):
+        self.pages, self.page_size, self.link_density = pages, page_size, link_density
+        self.random = random.Random(seed)
+
+    def names(self):
+        return ['BenchPage%d' % i for i in range(self.pages)]
+
+    def link(self):
+        #one link in ten is to a page that does not exist
+        return 'BenchPage%d' % self.random.randrange(int(self.pages * 1.1))
+
+    def sentence(self):
+        r = []
+        for i in range(self.random.randint(5, 15)):
+            x = self.random.random()
+            if x < self.link_density:
+                r.append(self.link())
+            elif x < self.link_density + 0.02:
+                r.append("''%s''" % self.random.choice(WORDS))
+            elif x < self.link_density + 0.03:
+                r.append("'''%s'''" % self.random.choice(WORDS))
+            elif x < self.link_density + 0.035:
+                r.append('http://www.example.com/%s' % self.random.choice(WORDS))
+            else:
+                r.append(self.random.choice(WORDS))
+        return ' '.join(r) + '.'
+
+    def text(self):
+        lines, size = [], 0
+        while size < self.page_size:
+            x = self.random.random()
+            if x < 0.5:
+                line = ' '.join([self.sentence() for i in range(self.random.randint(1, 4))])
+            elif x < 0.7:
+                line = '\n'.join([' ' * self.random.randint(1, 3) + self.random.choice('*#')
+                                  + ' ' + self.sentence() for i in range(self.random.randint(2, 6))])
+            elif x < 0.8:
+                line = '{{\n%s\n}}' % '\n'.join([self.sentence() for i in range(3)])
+            elif x < 0.85:
+                line = '__%s__' % self.sentence()
+            elif x < 0.87:
+                line = '[[macro(%s)]]' % self.random.randint(0, 9)
+            elif x < 0.9:
+                line = '----'
+            else:
+                line = ''
+            lines.append(line)
+            size += len(line) + 1
+        return '\n'.join(lines)
+
+    def write(self, root):
+        for i in ('text', 'templates', 'htdocs', 'data'):
+            os.mkdir(path.join(root, i))
+        for name in self.names():
+            file(path.join(root, 'text', name), 'w').write(self.text())
+        template = '<html><head><title><!--#self.title--></title></head><body><!--#wiki--></body></html>'
+        file(path.join(root, 'templates', 'default'), 'w').write(template)
+        for name in self.names()[:10]:
+            file(path.join(root, 'templates', name), 'w').write(template.replace('<body>', '<body class="special">'))
+
+
+def configure(root, indexes, storage='files'):
+    'give monkeywiki.py fresh state, configured to use the wiki in root'
+    mw = reload(monkeywiki)
+    mw.PATH_TO_WIKI_TEXT = path.join(root, 'text')
+    mw.PATH_TO_WIKI_DB = path.join(root, 'pages.db')
+    mw.PATH_TO_TEMPLATES = path.join(root, 'templates')
+    mw.PATH_TO_WIKI_DATA = indexes and path.join(root, 'data') or ''
+    mw.EDITABLE, mw.BACKUP_ON, mw.REWRITE_MODE = 1, 0, 0
+    if storage == 'sqlite':
+        files = mw.FileStorage()
+        mw.STORAGE, mw.storage = storage, mw.SQLiteStorage()
+        mw.storage.writemany([(i, files.read(i), files.mtime(i)) for i in files.pages()])
+    os.environ.update(DOCUMENT_ROOT=path.join(root, 'htdocs'), SCRIPT_NAME='/cgi-bin/wiki',
+                      SERVER_NAME='localhost', REQUEST_METHOD='POST')
+    return mw
+
+
+def cgi_script(root, mw):
+    '''write into root a copy of monkeywiki.py whose configuration section is as configure() left
+    mw, and a stub CGI script which runs it (as "monkeywiki.py cgistub" makes); return both'''
+    source = file(mw.__file__.rstrip('co')).read()
+    for name in ('PATH_TO_WIKI_TEXT', 'PATH_TO_WIKI_DB', 'PATH_TO_TEMPLATES', 'PATH_TO_WIKI_DATA',
+                 'EDITABLE', 'BACKUP_ON', 'REWRITE_MODE', 'STORAGE'):
+        source = re.sub('(?m)^%s = .*$' % name, '%s = %r' % (name, getattr(mw, name)), source, 1)
+    script, stub = path.join(root, 'monkeywiki.py'), path.join(root, 'wiki.cgi')
+    file(script, 'w').write(source)
+    subprocess.check_call([sys.executable, script, 'cgistub', stub], stdout=open(os.devnull, 'w'))
+    return script, stub
+
+
+def timed(f, repeat=1):
+    'best time in seconds of repeat calls to f'
+    r = None
+    for i in range(repeat):
+        start = time.time()
+        f()
+        t = time.time() - start
+        r = min(r, t) if r is not None else t
+    return r
+
+
+def run(corpus, options):
+    results = {}
+    root = tempfile.mkdtemp(prefix='mwbench')
+    try:
+        start = time.time()
+        corpus.write(root)
+        results['generate (s)'] = time.time() - start
+        mw = configure(root, options.indexes, options.storage)
+        names = corpus.names()
+        sample = random.Random(options.seed).sample(names, min(options.sample, len(names)))
+        texts = [file(path.join(root, 'text', i)).read() for i in sample]
+        if options.indexes:
+            results['reindex (s)'] = timed(mw.Command().reindex)
+
+        size = sum(map(len, texts)) / 1e6
+        results['htmlize (MB/s)'] = size / timed(lambda: map(mw.htmlize, texts), options.repeat)
+        for action in ('goto', 'backsearch', 'localmap'):
+            t = timed(lambda: [mw.WikiPage(i, action).web_output() for i in sample], options.repeat)
+            results['%s (s/page)' % action] = t / len(sample)
+        t = timed(lambda: [mw.WikiPage(i).web_stream().next() for i in sample], options.repeat)
+        results['goto first chunk (s/page)'] = t / len(sample)
+        for searchtext in ('monkey', 'wiki|page|text', 'mon.ey'):
+            results['SiteSearch %s (s)' % searchtext] = timed(
+                lambda: mw.WikiPage('SiteSearch', searchtext=searchtext).web_output())
+        results['SiteMap (s)'] = timed(lambda: mw.WikiPage('SiteMap').web_output())
+        results['RecentChanges (s)'] = timed(lambda: mw.WikiPage('RecentChanges').web_output(),
+                                             options.repeat)
+
+        def rename():
+            mw.WikiPage(names[0], 'rename', newname='BenchRenamed').web_output()
+            mw.WikiPage('BenchRenamed', 'rename', newname=names[0]).web_output()
+        results['rename (s)'] = timed(rename) / 2
+
+        renames = dict([(i, 'BenchRenamed%d' % n) for n, i in enumerate(sample[:20])])
+        def batchrename():
+            mw.batchrename.rename(renames)
+            mw.batchrename.rename(dict([(v, k) for k, v in renames.items()]))
+        results['rename %s at once (s)' % len(renames)] = timed(batchrename) / 2
+
+        #a CGI request starts Python afresh: time whole requests in new processes, both through a
+        #stub (so that the script is compiled once) and running the script directly
+        script, stub = cgi_script(root, mw)
+        env = dict(os.environ, REQUEST_METHOD='GET')
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        for name, command in (('cold start', [stub]),
+                              ('script cold start', [sys.executable, script])):
+            for action, query in (('goto', 'page=%s'), ('edit form', 'page=%s&action=edit')):
+                env['QUERY_STRING'] = query % sample[0]
+                results['%s %s (s)' % (name, action)] = timed(
+                    lambda: subprocess.check_call(command, env=env, stdout=open(os.devnull, 'w')),
+                    options.repeat * 5)
+    finally:
+        shutil.rmtree(root)
+    return results
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default='1000,10000,100000',
+                      help='comma-separated numbers of pages [%default]')
+    parser.add_option('--page-size', type='int', default=2000,
+                      help='approximate size of each page in bytes [%default]')
+    parser.add_option('--link-density', type='float', default=0.05,
+                      help='proportion of words which are WikiNames [%default]')
+    parser.add_option('--seed', type='int', default=0, help='random seed [%default]')
+    parser.add_option('--sample', type='int', default=50,
+                      help='number of pages on which per-page operations are timed [%default]')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='times to repeat quick operations, keeping the best [%default]')
+    parser.add_option('--indexes', action='store_true',
+                      help='keep indexes etc. in PATH_TO_WIKI_DATA, as a configured wiki can')
+    parser.add_option('--storage', choices=['files', 'sqlite'], default='files',
+                      help="where page text is kept: 'files' or 'sqlite' [%default]")
+    parser.add_option('--output', help='file to which to write the results as JSON')
+    parser.add_option('--compare', help='JSON results of an earlier run to compare with')
+    options, args = parser.parse_args()
+
+    results = {}
+    for size in [int(i) for i in options.sizes.split(',')]:
+        print >>sys.stderr, 'benchmarking %s pages...' % size
+        corpus = Corpus(size, options.page_size, options.link_density, options.seed)
+        results[str(size)] = run(corpus, options)
+    report = {'time': time.ctime(), 'python': sys.version.split()[0],
+              'options': options.__dict__, 'results': results}
+    if options.output:
+        json.dump(report, file(options.output, 'w'), indent=1, sort_keys=True)
+
+    earlier = options.compare and json.load(file(options.compare))['results'] or {}
+    for size in sorted(results, key=int):
+        print '%s pages' % size
+        for name in sorted(results[size]):
+            line = '  %-32s %12.6f' % (name, results[size][name])
+            old = earlier.get(size, {}).get(name)
+            if old:
+                line += '   (was %.6f, x%.2f)' % (old, results[size][name] / old)
+            print line
+
+
+if __name__ == '__main__': main()